@@ -1,47 +1,282 @@
 import argparse
+import collections
 import concurrent.futures
 import json
 import large_image
+import multiprocessing
 import os
+import pyvips
+import sys
 import tifftools
 
+import lazy_tiff
+import metrics
+from redact_image import IFDType, get_ifd_type
+
+SMALL_SIZE = 4096
+SKIP_TAGS = {324, 325, 273, 279, 34675}
+
+
+def walk_files(sources):
+    for src in sources:
+        for base, dirs, files in os.walk(src):
+            dirs.sort()
+            for file in sorted(files):
+                yield os.path.join(base, file), file
+
 
 def make_image_set(args):
-    with concurrent.futures.ThreadPoolExecutor() as pool:
-        for src in args.source:
-            for base, _, files in os.walk(src):
-                for file in sorted(files):
-                    path = os.path.join(src, base, file)
-                    pool.submit(process_file, path, args.out, file)
+    """
+    Process every file under the source directories.
+
+    Files are walked lazily and flow through two bounded stages: threads read
+    each file's TIFF structure and start reading the image data that will be
+    decoded, then worker processes decode, shrink, and encode the images.  At
+    most a few files per worker are in either stage at once.
+    """
+    workers = args.workers or os.cpu_count() or 1
+    limit = workers * 2
+    counts = collections.Counter()
+    files = walk_files(args.source)
+    exhausted = False
+    reading = collections.deque()
+    encoding = {}
+    # The reader threads may hold locks when an encoder process starts, so
+    # the encoders must not be forked from this process.
+    context = multiprocessing.get_context(
+        'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+    with concurrent.futures.ThreadPoolExecutor(args.readers) as readers, \
+            concurrent.futures.ProcessPoolExecutor(workers, mp_context=context) as encoders:
+        while not exhausted or reading or encoding:
+            while not exhausted and len(reading) < limit:
+                try:
+                    path, file = next(files)
+                except StopIteration:
+                    exhausted = True
+                    break
+                destroot = os.path.join(args.out, file)
+                if is_done(destroot):
+                    counts['skipped'] += 1
+                    metrics.count('files_skipped')
+                    continue
+                reading.append((path, destroot, readers.submit(plan_file, path)))
+            for item in list(reading):
+                if len(encoding) >= limit:
+                    break
+                path, destroot, future = item
+                if not future.done():
+                    continue
+                reading.remove(item)
+                try:
+                    info, level, macro = future.result()
+                except Exception as exc:
+                    report(args, counts, path, 'failed', exc)
+                    continue
+                future = encoders.submit(encode_file, path, destroot, level, macro)
+                encoding[future] = (path, destroot, info)
+            waiting = list(encoding)
+            if len(encoding) < limit:
+                waiting += [future for _, _, future in reading]
+            if not waiting:
+                continue
+            done, _ = concurrent.futures.wait(
+                waiting, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future not in encoding:
+                    continue
+                path, destroot, info = encoding.pop(future)
+                try:
+                    if not future.result():
+                        report(args, counts, path, 'unreadable')
+                        continue
+                    if info is not None:
+                        write_json(info, destroot)
+                except Exception as exc:
+                    report(args, counts, path, 'failed', exc)
+                    continue
+                report(args, counts, path, 'done')
+    sys.stderr.write('%d done, %d skipped, %d unreadable, %d failed\n' % (
+        counts['done'], counts['skipped'], counts['unreadable'], counts['failed']))
+
+
+def report(args, counts, path, status, exc=None):
+    counts[status] += 1
+    metrics.count('files_' + status)
+    if exc is not None:
+        sys.stderr.write('%s: failed: %r\n' % (path, exc))
+    elif args.verbose:
+        sys.stderr.write('[%d] %s: %s\n' % (sum(counts.values()), path, status))
+    sys.stderr.flush()
+
+
+def is_done(destroot):
+    return os.path.exists(destroot + '.json') and os.path.getsize(destroot + '.json') > 1024
+
+
+def pick_level(ifds, size):
+    """
+    Pick the smallest pyramid level or thumbnail IFD that is at least size
+    pixels on a side and has the aspect ratio of the full image.  If the full
+    image is smaller than that, pick the full image.  Levels stored as
+    SubIFDs of an image, as in OME-TIFF, are considered too.
+
+    Returns the (page, subifd) of the level, with a subifd of -1 for a
+    top-level IFD as libvips expects, or None if there is no image IFD.
+    """
+    levels = []
+    for idx, ifd in enumerate(ifds):
+        if get_ifd_type(ifd) in {IFDType.tile, IFDType.thumbnail}:
+            levels.append(ifd_size(ifd) + ((idx, -1), ))
+            subifds = ifd['tags'].get(tifftools.Tag.SubIFD.value, {}).get('ifds', [])
+            for subidx, subifd in enumerate(subifds):
+                if subifd:
+                    levels.append(ifd_size(subifd[0]) + ((idx, subidx), ))
+    if not levels:
+        return None
+    fullwidth, fullheight, fulllevel = max(levels)
+    levels = [
+        (width, height, level) for width, height, level in levels
+        if max(width, height) >= size and
+        abs(width * fullheight - height * fullwidth) <= 0.02 * width * fullheight]
+    if not levels:
+        return fulllevel
+    return min(levels)[2]
+
 
+def ifd_size(ifd):
+    return (ifd['tags'][tifftools.Tag.ImageWidth.value]['data'][0],
+            ifd['tags'][tifftools.Tag.ImageHeight.value]['data'][0])
 
-def process_file(path, rootout, file):
-    destroot = os.path.join(rootout, file)
-    if os.path.exists(destroot + '.json') and os.path.getsize(destroot + '.json') > 1024:
+
+def level_ifd(ifds, level):
+    """Return the IFD of a (page, subifd) level from pick_level."""
+    page, subifd = level
+    if subifd < 0:
+        return ifds[page]
+    return ifds[page]['tags'][tifftools.Tag.SubIFD.value]['ifds'][subifd][0]
+
+
+def prefetch(path, ifd):
+    # Ask the OS to start reading the image data of an IFD so that it is
+    # cached by the time it is decoded.
+    if not hasattr(os, 'posix_fadvise'):
         return
-    print(path)
+    tags = ifd['tags']
+    for offsets_tag, counts_tag in ((324, 325), (273, 279)):
+        if offsets_tag in tags and counts_tag in tags:
+            offsets = tags[offsets_tag]['data']
+            lengths = tags[counts_tag]['data']
+            start = min(offsets)
+            end = max(offset + length for offset, length in zip(offsets, lengths))
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, start, end - start, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+            return
+
+
+def plan_file(path):
+    """
+    Read the TIFF structure of a file and pick the IFDs to decode.
+
+    Returns the tifftools info with tag data loaded (None if the file is not
+    a TIFF), the (page, subifd) level to shrink for the low resolution image,
+    and the IFD index of the macro image.  These are None if there is no
+    suitable IFD.
+    """
+    with metrics.span('plan_file', file=path):
+        try:
+            tiff = lazy_tiff.LazyTiff(path)
+        except Exception:
+            # Not a TIFF, but large_image may still read it
+            return None, None, None
+        with tiff as info:
+            level = pick_level(info['ifds'], SMALL_SIZE)
+            macros = [
+                idx for idx, ifd in enumerate(info['ifds']) if get_ifd_type(ifd) == IFDType.macro]
+            if level is not None:
+                prefetch(path, level_ifd(info['ifds'], level))
+            # Skip tile offsets and byte counts
+            lazy_tiff.load_tags(info['ifds'], skip=SKIP_TAGS)
+    return info, level, macros[0] if macros else None
+
+
+def encode_file(path, destroot, level, macro):
+    """Write the low resolution and macro images.  Returns False on failure."""
+    with metrics.span('encode_file', file=path):
+        if level is not None and save_tiff_images(path, destroot, level, macro):
+            return True
+        metrics.count('large_image_fallbacks')
+        return save_large_image_images(path, destroot)
+
+
+def write_json(info, destroot):
+    json.dump(info, open(destroot + '.json', 'w'), indent=2,
+              cls=tifftools.commands.ExtendedJsonEncoder)
+
+
+def save_jpeg(image, path, quality):
+    if image.format != 'uchar':
+        image = image.scaleimage()
+    if image.bands in {2, 4}:
+        image = image.flatten(background=[255] * (image.bands - 1))
+    image.jpegsave(path, Q=quality)
+
+
+def save_small_image(path, destroot, level):
+    # Shrink the nearest pyramid level rather than having large_image
+    # assemble the region from tiles.
     try:
-        ts = large_image.open(path)
+        page, subifd = level
+        image = pyvips.Image.tiffload(path, page=page, subifd=subifd, access='sequential')
+        image = image.thumbnail_image(SMALL_SIZE, height=SMALL_SIZE, size='down')
+        save_jpeg(image, destroot + '_small.jpg', 90)
     except Exception:
-        return
+        return False
+    return True
+
+
+def save_tiff_images(path, destroot, level, macro):
+    if not save_small_image(path, destroot, level):
+        return False
+    if macro is None:
+        try:
+            ts = large_image.open(path)
+            save_large_image_macro(ts, destroot)
+        except Exception:
+            pass
+        return True
     try:
-        region, _ = ts.getRegion(
-            output=dict(maxWidth=4096, maxHeight=4096), encoding='JPEG', jpegQuality=90)
+        image = pyvips.Image.tiffload(path, page=macro, access='sequential')
+        save_jpeg(image, destroot + '_macro.jpg', 95)
     except Exception:
-        return
-    open(destroot + '_small.jpg', 'wb').write(region)
+        pass
+    return True
+
+
+def save_large_image_macro(ts, destroot):
     try:
         macro, _ = ts.getAssociatedImage('macro', encoding='JPEG')
         open(destroot + '_macro.jpg', 'wb').write(macro)
     except Exception:
         pass
-    info = tifftools.read_tiff(path)
-    # Remove tile offsets and byte counts
-    for ifd in info['ifds']:
-        for tag in {324, 325, 273, 279, 34675}:
-            ifd['tags'].pop(tag, None)
-    json.dump(info, open(destroot + '.json', 'w'), indent=2,
-              cls=tifftools.commands.ExtendedJsonEncoder)
+
+
+def save_large_image_images(path, destroot):
+    try:
+        ts = large_image.open(path)
+    except Exception:
+        return False
+    try:
+        region, _ = ts.getRegion(
+            output=dict(maxWidth=SMALL_SIZE, maxHeight=SMALL_SIZE),
+            encoding='JPEG', jpegQuality=90)
+    except Exception:
+        return False
+    open(destroot + '_small.jpg', 'wb').write(region)
+    save_large_image_macro(ts, destroot)
+    return True
 
 
 if __name__ == '__main__':
@@ -53,7 +288,17 @@ if __name__ == '__main__':
     parser.add_argument(
         '--out', required=True,
         help='Output directory.')
+    parser.add_argument(
+        '--workers', type=int,
+        help='Number of processes decoding and encoding images.  Defaults to '
+        'the number of CPUs.')
+    parser.add_argument(
+        '--readers', type=int, default=8,
+        help='Number of threads reading file structure ahead of the encoders.')
     parser.add_argument(
         '--verbose', '-v', action='count', default=0, help='Increase output.')
+    metrics.add_arguments(parser)
     args = parser.parse_args()
-    make_image_set(args)
+    metrics.configure_from_args(args)
+    with metrics.span('make_image_set'):
+        make_image_set(args)
@@ -0,0 +1,208 @@
+import os
+import struct
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from tifftools import Datatype, Tag, TifftoolsError
+from tifftools.constants import TiffConstantSet, get_or_create_tag
+from tifftools.tifftools import check_offset
+
+import metrics
+
+
+class LazyTagInfo(dict):
+    """A tifftools tag record whose data is read when it is first accessed."""
+
+    def __init__(self, tiff: 'LazyTiff', **kwargs):
+        super().__init__(**kwargs)
+        self._tiff = tiff
+
+    def _loadable(self) -> bool:
+        length = self['count'] * Datatype[self['datatype']].size
+        return check_offset(self._tiff.size, self.get('offset', self['datapos']), length)
+
+    def __contains__(self, key: Any) -> bool:
+        if key == 'data' and not dict.__contains__(self, key):
+            return self._loadable()
+        return dict.__contains__(self, key)
+
+    def __missing__(self, key: Any) -> Any:
+        if key != 'data' or not self._loadable():
+            raise KeyError(key)
+        self['data'] = self._tiff.read_tag_data(self)
+        return self['data']
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        return self[key] if key in self else default
+
+    def __reduce__(self):
+        # Copies and pickles are plain tag records, so read the data first.
+        if 'data' in self:
+            self['data']
+        return dict, (dict(self), )
+
+
+class LazyTiff:
+    """
+    Read the IFD structure of a TIFF file without reading tag data.
+
+    This produces the same info dictionary as tifftools.read_tiff, but only
+    the directory entries are parsed up front.  The data of a tag is read from
+    the open file when it is first accessed, so large arrays such as tile
+    offsets are never read unless they are used.  Sub-IFD offsets are read to
+    follow the IFD tree.  Use as a context manager; tag data must be accessed
+    before the file is closed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fptr = open(path, 'rb')
+        try:
+            self.info = self.read_tiff()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self) -> Dict[str, Any]:
+        return self.info
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.fptr:
+            self.fptr.close()
+            self.fptr = None
+
+    def read_tiff(self) -> Dict[str, Any]:
+        """Read the header and IFD chain, matching tifftools.read_tiff."""
+        self.fptr.seek(0, os.SEEK_END)
+        self.size = self.fptr.tell()
+        self.fptr.seek(0)
+        header = self.fptr.read(4)
+        if header not in (b'II\x2a\x00', b'MM\x00\x2a', b'II\x2b\x00', b'MM\x00\x2b'):
+            raise TifftoolsError('Not a known tiff header for %s' % self.path)
+        info: Dict[str, Any] = {
+            'ifds': [],
+            'path_or_fobj': self.path,
+            'size': self.size,
+            'header': header,
+            'bigEndian': header[:2] == b'MM',
+            'bigtiff': b'\x2b' in header[2:4],
+        }
+        info['endianPack'] = bom = '>' if info['bigEndian'] else '<'
+        self.info = info
+        self.visited: Set[int] = set()
+        if info['bigtiff']:
+            offsetsize, zero, nextifd = struct.unpack(bom + 'HHQ', self.fptr.read(12))
+            if offsetsize != 8 or zero != 0:
+                raise TifftoolsError('Unexpected offset size')
+        else:
+            nextifd = struct.unpack(bom + 'L', self.fptr.read(4))[0]
+        info['firstifd'] = nextifd
+        while nextifd:
+            nextifd = self.read_ifd(nextifd, info['ifds'])
+        return info
+
+    def read_ifd(
+        self, ifd_offset: int, ifd_list: List[Dict[str, Any]], tagSet: TiffConstantSet = Tag
+    ) -> Optional[int]:
+        """Read the directory entries of an IFD and any subIFDs."""
+        info = self.info
+        bom = info['endianPack']
+        if ifd_offset in self.visited or not check_offset(
+                self.size, ifd_offset, 16 if info['bigtiff'] else 6):
+            return None
+        self.visited.add(ifd_offset)
+        if info['bigtiff']:
+            countfmt, entryfmt, datalen = 'Q', 'HHQQ', 8
+        else:
+            countfmt, entryfmt, datalen = 'H', 'HHLL', 4
+        countlen = struct.calcsize(bom + countfmt)
+        entrylen = struct.calcsize(bom + entryfmt)
+        self.fptr.seek(ifd_offset)
+        tagcount = struct.unpack(bom + countfmt, self.fptr.read(countlen))[0]
+        # Read every entry and the next IFD pointer (8 bytes, in case of NDPI)
+        # in one request.
+        entries = self.fptr.read(tagcount * entrylen + 8)
+        metrics.count('bytes_read', countlen + len(entries))
+        ifd: Dict[str, Any] = {
+            'offset': ifd_offset,
+            'tags': {},
+            'path_or_fobj': info['path_or_fobj'],
+            'size': self.size,
+            'bigEndian': info['bigEndian'],
+            'bigtiff': info['bigtiff'],
+            'tagcount': tagcount,
+        }
+        for idx in range(tagcount):
+            tag, datatype, count, data = struct.unpack_from(
+                bom + entryfmt, entries, idx * entrylen)
+            if datatype not in Datatype:
+                continue
+            taginfo = LazyTagInfo(
+                self, datatype=datatype, count=count,
+                datapos=ifd_offset + countlen + (idx + 1) * entrylen - datalen)
+            if count * Datatype[datatype].size > datalen:
+                if (tagSet and tag in tagSet and tagSet[tag].get('ndpi_offset') and
+                        self.size >= 0x100000000):
+                    info['ndpi'] = True
+                    if data < ifd_offset:
+                        data = ifd_offset - ((ifd_offset - data) & 0xFFFFFFFF)
+                taginfo['offset'] = data
+            ifd['tags'][tag] = taginfo
+        if info['bigtiff'] or info.get('ndpi'):
+            nextifd = struct.unpack_from(bom + 'Q', entries, tagcount * entrylen)[0]
+        else:
+            nextifd = struct.unpack_from(bom + 'L', entries, tagcount * entrylen)[0]
+        for tag, taginfo in ifd['tags'].items():
+            tag = get_or_create_tag(tag, tagSet)
+            if not ((hasattr(tag, 'isIFD') and tag.isIFD()) or
+                    Datatype[taginfo['datatype']] in (Datatype.IFD, Datatype.IFD8)):
+                continue
+            if 'data' not in taginfo:
+                continue
+            taginfo['ifds'] = []
+            for subifd_offset in taginfo['data']:
+                subifd_list: List[Dict[str, Any]] = []
+                taginfo['ifds'].append(subifd_list)
+                nextsubifd = subifd_offset
+                while nextsubifd:
+                    nextsubifd = self.read_ifd(
+                        nextsubifd, subifd_list, getattr(tag, 'tagset', None))
+        ifd_list.append(ifd)
+        return nextifd
+
+    def read_tag_data(self, taginfo: Dict[str, Any]) -> Any:
+        """Read and decode the data of a tag the same way tifftools does."""
+        datatype = Datatype[taginfo['datatype']]
+        count = taginfo['count']
+        self.fptr.seek(taginfo.get('offset', taginfo['datapos']))
+        rawdata = self.fptr.read(count * datatype.size)
+        metrics.count('bytes_read', len(rawdata))
+        if datatype.pack:
+            return list(struct.unpack(self.info['endianPack'] + datatype.pack * count, rawdata))
+        if datatype == Datatype.ASCII:
+            try:
+                return rawdata.rstrip(b'\x00').decode()
+            except UnicodeDecodeError:
+                return rawdata
+        return rawdata
+
+
+def load_tags(ifds: List[Dict[str, Any]], skip: Iterable[int] = ()) -> None:
+    """
+    Read the data of every tag in a list of IFDs and their subIFDs.
+
+    Tags listed in skip are removed instead of being read.
+    """
+    skip = set(skip)
+    for ifd in ifds:
+        for tag in list(ifd['tags']):
+            if tag in skip:
+                ifd['tags'].pop(tag)
+                continue
+            taginfo = ifd['tags'][tag]
+            if 'data' in taginfo:
+                taginfo['data']
+            for subifds in taginfo.get('ifds', []):
+                load_tags(subifds, skip)
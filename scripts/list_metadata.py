@@ -1,13 +1,25 @@
 import argparse
+import concurrent.futures
 import json
 import os
+import sqlite3
 import sys
 
 import tifftools
 from tifftools import Datatype
 
+import lazy_tiff
+import metrics
+import phi_matcher
 
-def add_meta(meta, key, value):
+
+def add_meta(meta, key, value, count=1):
+    """
+    Record a value for a key.
+
+    meta maps each key to an insertion-ordered dictionary of its values and
+    how many times each was seen.
+    """
     key = key.strip()
     value = str(value).strip()
     if key.endswith(' Q') and value.split(';')[0].isdigit():
@@ -18,9 +30,8 @@ def add_meta(meta, key, value):
     except Exception:
         if not value or str(value).lower() in {'none', 'true', 'false'}:
             return
-    meta.setdefault(key, [])
-    if value not in meta[key]:
-        meta[key].append(value)
+    meta.setdefault(key, {})
+    meta[key][value] = meta[key].get(value, 0) + count
 
 
 def flatten(ifds, meta=None, tagSet=tifftools.Tag):
@@ -31,22 +42,22 @@ def flatten(ifds, meta=None, tagSet=tifftools.Tag):
             tag = tifftools.commands.get_or_create_tag(
                 tag, tagSet, {'datatype': Datatype[taginfo['datatype']]})
             if not tag.isIFD() and taginfo['datatype'] not in (Datatype.IFD, Datatype.IFD8):
+                # Only ASCII and date values are kept.  Check the datatype
+                # first, since accessing the data reads it from the file.
+                # UNDEFINED data is bytes and is never kept.
+                isascii = taginfo['datatype'] == Datatype.ASCII
+                if not isascii and (taginfo['datatype'] == Datatype.UNDEFINED or
+                                    'date' not in tag['name'].lower()):
+                    continue
                 if 'data' not in taginfo:
                     continue
-                if taginfo['datatype'] == Datatype.ASCII:
+                if isascii:
                     value = taginfo['data']
                     # change this to deal with Philips
                     if value.startswith('<?xml'):
                         continue
-                elif taginfo['datatype'] == Datatype.UNDEFINED:
-                    try:
-                        value = taginfo['data'].encode()
-                    except Exception:
-                        continue
-                elif 'date' in tag['name'].lower():
-                    value = str(taginfo['data'])
                 else:
-                    continue
+                    value = str(taginfo['data'])
                 add_meta(meta, tag['name'], value)
             elif 'ifds' in taginfo:
                 subifdList.append((tag, taginfo))
@@ -58,16 +69,16 @@ def flatten(ifds, meta=None, tagSet=tifftools.Tag):
 
 def check_aperio(meta):
     for key in list(meta.keys()):
-        for value in meta[key][:]:
+        for value, count in list(meta[key].items()):
             if value.startswith('Aperio '):
-                meta[key].remove(value)
+                meta[key].pop(value)
                 if not len(meta[key]):
                     meta.pop(key, None)
                 try:
                     for entry in value.replace('\r', '\n').split('\n', 1)[1].strip().split('|'):
                         if '=' in entry:
                             skey, svalue = entry.split('=', 1)
-                            add_meta(meta, skey, svalue)
+                            add_meta(meta, skey, svalue, count)
                 except Exception:
                     pass
     return meta
@@ -75,15 +86,15 @@ def check_aperio(meta):
 
 def check_imagej(meta):
     for key in list(meta.keys()):
-        for value in meta[key][:]:
+        for value, count in list(meta[key].items()):
             if value.startswith('ImageJ='):
-                meta[key].remove(value)
+                meta[key].pop(value)
                 if not len(meta[key]):
                     meta.pop(key, None)
                 for entry in value.replace('\r', '\n').split('\n', 1)[1].strip().split('\n'):
                     if '=' in entry:
                         skey, svalue = entry.split('=', 1)
-                        add_meta(meta, skey, svalue)
+                        add_meta(meta, skey, svalue, count)
     return meta
 
 
@@ -91,23 +102,23 @@ def check_hamamatsu(meta):
     pms = meta.pop('NDPI_PROPERTY_MAP', None)
     if not pms:
         return meta
-    for pm in pms:
+    for pm, count in pms.items():
         for entry in pm.split('\r\n'):
             if '=' in entry:
                 skey, svalue = entry.split('=', 1)
-                add_meta(meta, skey, svalue)
+                add_meta(meta, skey, svalue, count)
     return meta
 
 
 def unjson(meta):
     for key in list(meta.keys()):
-        for value in meta[key][:]:
+        for value, count in list(meta[key].items()):
             if value.startswith('{'):
                 try:
                     jvalue = json.loads(value)
                 except Exception:
                     continue
-                meta[key].remove(value)
+                meta[key].pop(value)
                 if not len(meta[key]):
                     meta.pop(key, None)
                 for skey, svalue in jvalue.items():
@@ -117,39 +128,217 @@ def unjson(meta):
                         for tkey, tvalue in svalue.items():
                             if isinstance(tvalue, dict):
                                 for ukey, uvalue in tvalue.items():
-                                    add_meta(meta, ukey, str(uvalue))
+                                    add_meta(meta, ukey, str(uvalue), count)
                             else:
-                                add_meta(meta, tkey, str(tvalue))
+                                add_meta(meta, tkey, str(tvalue), count)
                     else:
-                        add_meta(meta, skey, str(svalue))
+                        add_meta(meta, skey, str(svalue), count)
     return meta
 
 
-def list_metadata(args):
-    meta = {}
-    if args.collection and os.path.exists(args.collection):
-        meta = json.load(open(args.collection))
-    for src in args.source:
-        if args.verbose:
-            sys.stderr.write('%s\n' % src)
-            sys.stderr.flush()
+def file_metadata(src):
+    """
+    Collect the flattened, vendor-expanded metadata of a single file.
+
+    Returns a dictionary of keys to dictionaries of value counts, or None if
+    the file cannot be read as a TIFF.
+    """
+    with metrics.span('file_metadata', file=src):
         try:
-            info = tifftools.read_tiff(src)
+            with lazy_tiff.LazyTiff(src) as info:
+                meta = flatten(info['ifds'])
         except Exception:
-            continue
-        meta = flatten(info['ifds'], meta=meta)
+            return None
         meta = unjson(meta)
         meta = check_aperio(meta)
         meta = check_hamamatsu(meta)
         meta = check_imagej(meta)
+    return meta
+
+
+def merge_meta(meta, partial):
+    """
+    Merge the metadata of one file or collection into another.
+
+    Values are already filtered and expanded, so merging is an ordered union
+    per key that sums the counts and can be applied in any grouping.
+    """
+    for key, values in partial.items():
+        meta.setdefault(key, {})
+        for value, count in values.items():
+            meta[key][value] = meta[key].get(value, 0) + count
+    return meta
+
+
+def index_meta(index, src, partial):
+    """Record src as a source of every value in its metadata."""
+    for values in partial.values():
+        for value in values:
+            index.setdefault(value, {})[src] = True
+    return index
+
+
+def file_identity(src):
+    """Return the (absolute path, size, mtime) of a file, or None."""
+    try:
+        stat = os.stat(src)
+    except OSError:
+        return None
+    return os.path.abspath(src), stat.st_size, stat.st_mtime_ns
+
+
+class MetadataCache:
+    """
+    An SQLite store of each file's metadata keyed by its identity.
+
+    A file's entry is only used while its path, size, and mtime are
+    unchanged, so re-runs only parse new or modified files.  Files that could
+    not be read are stored too, so they are not retried until they change.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, meta TEXT)')
+        self.pending = 0
+
+    def rows(self):
+        """Return a dictionary of each cached path to its (size, mtime, metadata JSON)."""
+        return {path: (size, mtime, meta) for path, size, mtime, meta in self.conn.execute(
+            'SELECT path, size, mtime, meta FROM files')}
+
+    def delete(self, paths):
+        self.conn.executemany('DELETE FROM files WHERE path = ?', [(path, ) for path in paths])
+
+    def put(self, identity, meta):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO files (path, size, mtime, meta) VALUES (?, ?, ?, ?)',
+            tuple(identity) + (json.dumps(meta), ))
+        self.pending += 1
+        if self.pending >= 1000:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def read_json(path):
+    return json.load(open(path)) if path and os.path.exists(path) else {}
+
+
+def read_collection(path):
+    """
+    Read a collection as a dictionary of each file's metadata.
+
+    Older collections only stored the merged metadata, as a list or counts of
+    values per key.  Their files are unknown, so that metadata is returned as
+    the contribution of a single unnamed file ('').
+    """
+    data = read_json(path)
+    if set(data) == {'meta', 'files'}:
+        return data['files']
+    for key, values in data.items():
+        if isinstance(values, list):
+            data[key] = dict.fromkeys(values, 1)
+    return {'': data} if data else {}
+
+
+def collection_meta(files):
+    """Merge the metadata of each file of a collection."""
+    meta = {}
+    for partial in files.values():
+        meta = merge_meta(meta, partial)
+    return meta
+
+
+def write_collection(path, files, meta=None):
+    """
+    Write the merged metadata of a collection along with each file's own
+    metadata, so that reprocessing a file replaces its counts rather than
+    adding to them.
+    """
+    if meta is None:
+        meta = collection_meta(files)
+    json.dump({'meta': meta, 'files': files}, open(path, 'w'))
+
+
+def list_metadata(args):
+    files = read_collection(args.collection)
+    cache = MetadataCache(args.cache) if args.cache else None
+    rows = {}
+    missing = set()
+    if cache:
+        # The cache holds every file seen so far, so the merged view is
+        # rebuilt from it rather than added to the collection.  Files that
+        # have been deleted or moved away are dropped from it.
+        rows = cache.rows()
+        missing = {path for path in rows if not os.path.exists(path)}
+        cache.delete(missing)
+        for path in missing:
+            rows.pop(path)
+        files.update((path, json.loads(row[2])) for path, row in rows.items())
+    todo = []
+    identities = {}
+    for src in args.source:
+        identities[src] = identity = file_identity(src)
+        if cache and identity and rows.get(identity[0], ())[:2] == identity[1:]:
+            metrics.count('cache_hits')
+            if args.verbose >= 2:
+                sys.stderr.write('%s (cached)\n' % src)
+                sys.stderr.flush()
+            continue
+        if cache:
+            metrics.count('cache_misses')
+        todo.append(src)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for src, partial in zip(todo, pool.map(file_metadata, todo, chunksize=8)):
+            if args.verbose:
+                sys.stderr.write('%s\n' % src)
+                sys.stderr.flush()
+            if cache and identities[src]:
+                cache.put(identities[src], partial)
+            files[os.path.abspath(src)] = partial
+    if cache:
+        cache.close()
+    # Files that could not be read contribute nothing
+    files = {src: partial for src, partial in files.items() if partial}
+    meta = collection_meta(files)
+    index = {}
+    if args.index:
+        # The entries of files that were read are rebuilt, and those of files
+        # dropped from the cache are removed
+        for value, srcs in read_json(args.index).items():
+            srcs = [src for src in srcs if src not in files and src not in missing]
+            if srcs:
+                index[value] = dict.fromkeys(srcs, True)
+        for src, partial in files.items():
+            if src:
+                index = index_meta(index, src, partial)
     if args.out:
         outptr = open(args.out, 'w')
     else:
         outptr = sys.stdout
     for key, values in sorted(meta.items()):
+        values = list(values)
         outptr.write('%s: %s\n' % (key, values[0] if len(values) == 1 else values))
+    if args.phi or args.patterns or args.literals:
+        patterns = phi_matcher.default_patterns.split('\n')
+        if args.patterns:
+            patterns = phi_matcher.read_lines(args.patterns)
+        literals = phi_matcher.read_lines(args.literals) if args.literals else []
+        matcher = phi_matcher.PHIMatcher(patterns, literals)
+        for key, value, match in matcher.scan(
+                (key, value) for key, values in sorted(meta.items()) for value in values):
+            outptr.write('PHI %s: %s (%s)\n' % (key, value, match.text))
+            for src in index.get(value, {}):
+                outptr.write('  %s\n' % src)
     if args.collection:
-        meta = json.dump(meta, open(args.collection, 'w'))
+        write_collection(args.collection, files, meta)
+    if args.index:
+        json.dump({value: list(srcs) for value, srcs in index.items()}, open(args.index, 'w'))
 
 
 if __name__ == '__main__':
@@ -160,12 +349,43 @@ if __name__ == '__main__':
     parser.add_argument(
         '--collection',
         help='A file path to read and write collected metadata.  Use this to '
-        'merge multiple runs of the program.')
+        'merge multiple runs of the program.  The metadata of each file is '
+        'kept, so files that are processed again replace their earlier '
+        'values.')
     parser.add_argument(
         '--out',
         help='If specified, output the results to this text file.  Otherwise, '
         'output to stdout.')
+    parser.add_argument(
+        '--cache',
+        help='A SQLite file of per-file metadata.  Files whose path, size, '
+        'and modification time are unchanged since they were cached are not '
+        'read again.  The listing covers every file in the cache.')
+    parser.add_argument(
+        '--index',
+        help='A file path to read and write an index of each value to the '
+        'files it was found in.  When scanning for PHI, the files containing '
+        'each matching value are listed.')
+    parser.add_argument(
+        '--workers', type=int,
+        help='Number of worker processes.  Defaults to the number of CPUs.')
+    parser.add_argument(
+        '--phi', action='store_true',
+        help='Scan every value for possible PHI using the default OCR patterns '
+        'and list the values that match.')
+    parser.add_argument(
+        '--patterns',
+        help='A file of tesseract-style user patterns, one per line, to scan '
+        'values with instead of the default patterns.  Implies --phi.')
+    parser.add_argument(
+        '--literals',
+        help='A file of literal strings, one per line, such as names, to scan '
+        'values for.  End a line with * to match it as a prefix, such as for '
+        'MRNs.  Implies --phi.')
     parser.add_argument(
         '--verbose', '-v', action='count', default=0, help='Increase output.')
+    metrics.add_arguments(parser)
     args = parser.parse_args()
-    list_metadata(args)
+    metrics.configure_from_args(args)
+    with metrics.span('list_metadata'):
+        list_metadata(args)
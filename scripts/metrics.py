@@ -0,0 +1,203 @@
+"""
+Lightweight instrumentation shared by the scripts.
+
+Code counts events and times stages with the module-level functions:
+
+    metrics.count('bytes_read', len(data))
+    with metrics.span('ocr_image', file=src):
+        ...
+
+Nothing is recorded until configure() is called, which the scripts do from
+their --trace and --profile options.  With a trace file, every span and, when
+each process exits, a summary of that process's counters, span timings, CPU
+time, and peak resident memory are appended to the file as JSON lines.  Worker
+processes inherit the configuration and write their own lines, tagged with
+their pid.
+
+With a profile directory, each process also runs cProfile and writes
+<script>.<pid>.prof there when it exits, for pstats or snakeviz.  Sampling
+profilers such as py-spy need no hooks; attach them to the pids in the trace.
+"""
+
+import contextlib
+import cProfile
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TRACE_ENV = 'IMAGEDEPHI_TRACE'
+PROFILE_ENV = 'IMAGEDEPHI_PROFILE'
+ECHO_ENV = 'IMAGEDEPHI_ECHO'
+
+
+def peak_rss(who: str = 'self') -> Optional[int]:
+    """Return the peak resident memory in bytes of this process or its children."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(
+        resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes except on macOS
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+class Metrics:
+    """Counters and span timings for one process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.trace_fd: Optional[int] = None
+        self.profile_dir: Optional[str] = None
+        self.profiler: Optional[cProfile.Profile] = None
+        self.echo = False
+        self.reset()
+
+    def reset(self) -> None:
+        self.counters: Dict[str, int] = {}
+        self.timers: Dict[str, list] = {}
+        self.start = time.time()
+        self.cpu_start = time.process_time()
+
+    def configure(
+        self, trace: Optional[str] = None, profile: Optional[str] = None, echo: bool = False,
+    ) -> None:
+        """
+        Start recording.  trace is a JSON lines file to append to, profile a
+        directory for cProfile output, and echo prints each span to stderr.
+        These settings are passed to worker processes through the environment.
+        """
+        if trace:
+            os.environ[TRACE_ENV] = os.path.abspath(trace)
+        if profile:
+            os.makedirs(profile, exist_ok=True)
+            os.environ[PROFILE_ENV] = os.path.abspath(profile)
+        if echo:
+            os.environ[ECHO_ENV] = '1'
+        self.setup()
+        if self.enabled:
+            self.record({
+                'type': 'run', 'argv': sys.argv, 'python': sys.version.split()[0]})
+
+    def setup(self) -> None:
+        """Open the trace and start profiling as the environment says."""
+        trace = os.environ.get(TRACE_ENV)
+        if trace and self.trace_fd is None:
+            self.trace_fd = os.open(trace, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.profile_dir = os.environ.get(PROFILE_ENV)
+        self.echo = bool(os.environ.get(ECHO_ENV))
+        if self.profile_dir and self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if self.enabled or not (trace or self.profile_dir or self.echo):
+            return
+        self.enabled = True
+        multiprocessing.util.register_after_fork(self, Metrics.after_fork)
+        multiprocessing.util.Finalize(self, self.flush, exitpriority=0)
+
+    def after_fork(self) -> None:
+        # A forked worker starts with a copy of its parent's counts; start
+        # over and write its own summary when it exits.  The trace file
+        # descriptor is shared, which is safe since it is opened to append.
+        self.reset()
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler = None
+        self.enabled = False
+        self.setup()
+
+    def count(self, name: str, value: int = 1) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def span(self, name: str, **fields: Any) -> Iterator[None]:
+        """Time a block of code.  Extra fields are included in the trace."""
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            with self.lock:
+                timer = self.timers.setdefault(name, [0, 0.0])
+                timer[0] += 1
+                timer[1] += seconds
+            if self.echo:
+                sys.stderr.write('  %s: %5.3fs\n' % (name, seconds))
+                sys.stderr.flush()
+            self.record(dict(
+                type='span', name=name, start=round(start, 6), seconds=round(seconds, 6),
+                **fields))
+
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'type': 'summary',
+                'process': multiprocessing.current_process().name,
+                'wall': round(time.time() - self.start, 6),
+                'cpu': round(time.process_time() - self.cpu_start, 6),
+                'peak_rss': peak_rss(),
+                'children_peak_rss': peak_rss('children'),
+                'counters': dict(self.counters),
+                'timers': {
+                    name: {'count': count, 'seconds': round(seconds, 6)}
+                    for name, (count, seconds) in self.timers.items()},
+            }
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        if self.trace_fd is None:
+            return
+        entry = dict(entry, pid=os.getpid(), time=round(time.time(), 6))
+        # One write per line so lines from several processes don't interleave
+        os.write(self.trace_fd, (json.dumps(entry, default=str) + '\n').encode())
+
+    def flush(self) -> None:
+        """Write the summary and profile of this process."""
+        if self.profiler is not None:
+            self.profiler.disable()
+            script = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+            self.profiler.dump_stats(os.path.join(
+                self.profile_dir, '%s.%d.prof' % (script, os.getpid())))
+            self.profiler = None
+        self.record(self.summary())
+
+
+_metrics = Metrics()
+configure = _metrics.configure
+count = _metrics.count
+span = _metrics.span
+summary = _metrics.summary
+
+if any(os.environ.get(env) for env in (TRACE_ENV, PROFILE_ENV, ECHO_ENV)):
+    # A spawned worker process
+    _metrics.setup()
+
+
+def add_arguments(parser) -> None:
+    """Add the --trace and --profile options to a script's argument parser."""
+    parser.add_argument(
+        '--trace',
+        help='Append timings, counters, and peak memory use of each process '
+        'to this file as JSON lines.')
+    parser.add_argument(
+        '--profile',
+        help='Write cProfile statistics for each process to this directory.')
+
+
+def configure_from_args(args, echo: bool = False) -> None:
+    if args.trace or args.profile or echo:
+        configure(args.trace, args.profile, echo)
@@ -1,62 +1,37 @@
-# pip install pyyaml pytesseract large-image psutil
+# pip install pyyaml pytesseract large-image psutil pyvips tifftools
 # apt-get install tesseract-ocr
 
 import argparse
-import concurrent.futures
+import collections
+import heapq
 import io
 import itertools
 import json
 import logging
 import multiprocessing
+import multiprocessing.connection
 import os
 import re
 import sys
-import time
 
 import large_image
+import numpy
 import PIL.Image
-import PIL.ImageOps
 import psutil
 import pytesseract
+import pyvips
 import yaml
 
+import lazy_tiff
+import metrics
+import phi_matcher
+from redact_image import IFDType, get_ifd_type
+
 logger = logging.getLogger('large_image')
 logger.setLevel(logging.CRITICAL)
 
-start_time = time.time()
-
-# \c - alpha (regex [a-zA-Z], except adds unicode)
-# \d - digit (regex \d)
-# \n - digit or alpha (regex \w)
-# \p - punctuation (regex [^\w\s])
-# \a - lower alpha (regex [a-z], but unicode)
-# \A - upper alpha (regex [A-Z], but unicode)
-# \* can repeat previous character (regex *)
-user_patterns = """TCGA-\\n\\n-\\n\\n\\n\\n-\\d\\d\\n-\\d\\d-\\n\\n\\d
-TCGA-\\n\\n-\\n\\n\\n\\n-\\d\\d\\n
-\\d\\d/\\d\\d/\\d\\d
-\\d/\\d\\d/\\d\\d
-\\d\\d/\\d/\\d\\d
-\\d/\\d/\\d\\d
-"""
-
-tesseractToRe = [
-    ('\\c', r'[a-zA-Z]'),
-    ('\\d', r'\d'),
-    ('\\n', r'\w'),
-    ('\\p', r'[^\w\s]'),
-    ('\\a', r'[a-Z]'),
-    ('\\A', r'[A=Z]'),
-    ('\\*', r'\w'),
-]
-re_patterns = []
-for pat in user_patterns.split('\n'):
-    if pat.strip():
-        pat = re.escape(pat.strip())
-        for tpat, rpat in tesseractToRe:
-            pat = pat.replace(re.escape(tpat), rpat)
-        re_patterns.append(pat)
-re_patterns = re.compile(r'(' + '|'.join(re_patterns) + r')')
+user_patterns = phi_matcher.default_patterns
+matcher = phi_matcher.PHIMatcher(user_patterns.split('\n'))
 
 
 # This could be something like '--psm 11 --oem 1'
@@ -64,87 +39,310 @@ open('/tmp/tesseract.patterns', 'w').write(user_patterns)
 tesseract_config = '--user-patterns /tmp/tesseract.patterns'
 # tesseract_config = None
 
+associated_ifd_types = (IFDType.label, IFDType.macro, IFDType.thumbnail)
+
+
+def contrast_luts(gray):
+    """
+    Build the autocontrast and equalize lookup tables for a grayscale array.
+
+    These match PIL.ImageOps.autocontrast and PIL.ImageOps.equalize, but are
+    computed from a single histogram and shared by every crop and rotation.
+    """
+    hist = numpy.bincount(gray.ravel(), minlength=256)
+    identity = numpy.arange(256)
+    used = numpy.flatnonzero(hist)
+    autocontrast = identity
+    if len(used) and used[-1] > used[0]:
+        lo, hi = used[0], used[-1]
+        scale = 255.0 / (hi - lo)
+        autocontrast = (identity * scale - lo * scale).astype(int)
+    equalize = identity
+    if len(used) > 1:
+        step = (hist.sum() - hist[used[-1]]) // 255
+        if step:
+            equalize = (step // 2 + numpy.concatenate(([0], numpy.cumsum(hist)[:-1]))) // step
+    return {
+        'autocontrast': numpy.clip(autocontrast, 0, 255).astype(numpy.uint8),
+        'equalize': numpy.clip(equalize, 0, 255).astype(numpy.uint8),
+    }
+
+
+def image_variants(image):
+    """
+    Yield ((crop, rotate, contrast), array) for each OCR variant of an image.
+
+    The image is converted to grayscale and each contrast adjustment is
+    applied once; crops and rotations are numpy views of those arrays.
+    """
+    gray = numpy.asarray(image.convert('L'))
+    adjusted = {None: gray}
+    for contrast, lut in contrast_luts(gray).items():
+        adjusted[contrast] = lut[gray]
+    height, width = gray.shape
+    for crop, rotate, contrast in itertools.product((0, 1, 2), (0, 1, 2, 3), adjusted):
+        subimage = adjusted[contrast][crop:height - crop, crop:width - crop]
+        yield (crop, rotate, contrast), numpy.rot90(subimage, rotate)
+
+
+def popcount(value):
+    return bin(value).count('1')
+
+
+def vote_text(options, words):
+    """
+    Pick the variant text that the other variants agree with most.
 
-def get_text_from_image(image):
+    options maps a bit per variant to that variant's text; words maps each
+    word to the bitwise-or of the variants it appears in.  The word present in
+    the most surviving variants is picked repeatedly and variants without it
+    are discarded until one variant remains.  Counts only drop as variants are
+    discarded, so stale heap entries are refreshed when they surface.
+
+    Returns the text and the fraction of variants containing each of its
+    words.
+    """
+    alive = 0
+    for bit in options:
+        alive |= bit
+    heap = [(-popcount(mask), word) for word, mask in words.items()]
+    heapq.heapify(heap)
+    while heap and popcount(alive) > 1:
+        count, word = heapq.heappop(heap)
+        current = popcount(words[word] & alive)
+        if current and current != -count:
+            heapq.heappush(heap, (-current, word))
+        elif current:
+            alive &= words[word]
+    # the lowest remaining bit is the earliest variant
+    text = options[alive & -alive]
+    confidence = {word: popcount(words[word]) / len(options) for word in text.split()}
+    return text, confidence
+
+
+def get_text_from_image(image, matcher=matcher):
+    """
+    OCR variants of an image and vote on the text.  Variants whose text has a
+    match for the PHIMatcher are preferred.  Returns the text and the
+    fraction of variants that agree on each word.
+    """
     words = {}
     options = {}
     match_words = {}
     match_options = {}
-    for crop, rotate, contrast in itertools.product(
-            (0, 1, 2),
-            (None, PIL.Image.ROTATE_90, PIL.Image.ROTATE_180, PIL.Image.ROTATE_270),
-            (None, 'autocontrast', 'equalize'),
-            ):
-        subimage = PIL.ImageOps.crop(image, crop)
-        if rotate:
-            subimage = subimage.transpose(rotate)
-        if contrast:
-            subimage = getattr(PIL.ImageOps, contrast)(subimage)
+    for idx, (key, subimage) in enumerate(image_variants(image)):
         text = pytesseract.image_to_string(subimage, config=tesseract_config).strip()
+        metrics.count('ocr_calls')
         text = text.replace('"', ' ').replace("'", ' ').replace('|', ' ').replace('@', '0')
         if not text.strip():
             continue
-        key = (crop, rotate, contrast)
+        bit = 1 << idx
         text_parts = [t for t in text.split() if re.search(r'\w', t)]
-        options[key] = ' '.join(text_parts)
+        options[bit] = ' '.join(text_parts)
         # if len(text.strip()):
-        #     print(crop, str(rotate)[:1], str(contrast)[:1],
-        #           ' '.join(text_parts))
+        #     print(key, ' '.join(text_parts))
         for word in text_parts:
-            words[word] = words.get(word, []) + [key]
-        match = re_patterns.search(options[key])
+            words[word] = words.get(word, 0) | bit
+        match = matcher.search(options[bit])
         if match:
-            match_options[key] = options[key]
+            match_options[bit] = options[bit]
             for word in text_parts:
-                match_words[word] = match_words.get(word, []) + [key]
+                match_words[word] = match_words.get(word, 0) | bit
     if not(words):
-        return ''
+        return '', {}
     if match_options:
         options, words = match_options, match_words
-    while len(options) > 1 and len(words):
-        _, word, wopts = sorted((-len(val), word, val) for word, val in words.items())[0]
-        words.pop(word, None)
-        for w in list(words):
-            words[w] = [wopt for wopt in words[w] if wopt in wopts]
-            if not len(words[w]):
-                words.pop(w)
-        options = {k: v for k, v in options.items() if k in wopts}
-    return next(iter(options.values()))
+    return vote_text(options, words)
+
+
+class AdaptivePool:
+    """
+    Run ocr_image in worker processes, sizing concurrency to a memory budget.
+
+    The resident memory of each busy worker (including its tesseract
+    subprocesses) is sampled while a task runs.  The number of concurrent
+    tasks is the memory budget divided by the largest recent per-task peak,
+    bounded by max_workers, so concurrency grows when slides turn out to be
+    cheap and shrinks when they are not.  Workers whose memory stays above
+    leak_limit once a task is done are replaced.
+    """
+
+    def __init__(self, memory_budget, max_workers, leak_limit, initial_rss=1024 ** 3,
+                 verbose=0, literals=()):
+        self.memory_budget = memory_budget
+        self.max_workers = max_workers
+        self.leak_limit = leak_limit
+        self.initial_rss = initial_rss
+        self.peaks = collections.deque(maxlen=16)
+        self.verbose = verbose
+        self.literals = list(literals)
+        self.workers = []
+        self.last_target = None
+
+    def task_rss(self):
+        return max(self.peaks) if self.peaks else self.initial_rss
+
+    def target(self):
+        target = int(self.memory_budget // self.task_rss())
+        target = max(1, min(self.max_workers, target))
+        if target != self.last_target and self.verbose >= 2:
+            sys.stderr.write('Worker pool: %d (%3.1f GB per task)\n' % (
+                target, self.task_rss() / 1024 ** 3))
+            sys.stderr.flush()
+        self.last_target = target
+        return target
+
+    def run(self, sources):
+        """Yield (source, result) tuples in order of completion."""
+        pending = collections.deque(sources)
+        try:
+            while pending or self.busy():
+                self.dispatch(pending)
+                busy = self.busy()
+                ready = multiprocessing.connection.wait(
+                    [worker['conn'] for worker in busy], timeout=0.1)
+                for worker in busy:
+                    self.sample(worker)
+                    if worker['conn'] in ready:
+                        yield self.collect(worker)
+        finally:
+            for worker in self.workers[:]:
+                self.stop_worker(worker)
+
+    def busy(self):
+        return [worker for worker in self.workers if worker['src'] is not None]
+
+    def dispatch(self, pending):
+        target = self.target()
+        while pending:
+            busy = self.busy()
+            if len(busy) >= target:
+                break
+            # Don't start another task if the ones in flight plus a typical
+            # task would exceed the budget.
+            if busy and sum(worker['rss'] for worker in busy) + (
+                    self.task_rss()) > self.memory_budget:
+                break
+            idle = [worker for worker in self.workers if worker['src'] is None]
+            worker = idle[0] if idle else self.start_worker()
+            worker.update({'src': pending.popleft(), 'rss': 0, 'peak': 0})
+            worker['conn'].send(worker['src'])
+        idle = [worker for worker in self.workers if worker['src'] is None]
+        spare = len(idle) if not pending else len(self.workers) - target
+        for worker in idle[:max(0, spare)]:
+            self.stop_worker(worker)
+
+    def start_worker(self):
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=ocr_worker, args=(child_conn, self.literals), daemon=True)
+        process.start()
+        child_conn.close()
+        worker = {
+            'conn': conn,
+            'process': process,
+            'psutil': psutil.Process(process.pid),
+            'src': None,
+            'rss': 0,
+            'peak': 0,
+        }
+        self.workers.append(worker)
+        return worker
+
+    def stop_worker(self, worker):
+        self.workers.remove(worker)
+        try:
+            worker['conn'].send(None)
+        except Exception:
+            pass
+        worker['conn'].close()
+        worker['process'].join(5)
+        if worker['process'].is_alive():
+            worker['process'].terminate()
+            worker['process'].join()
+
+    def sample(self, worker):
+        try:
+            procs = [worker['psutil']] + worker['psutil'].children(recursive=True)
+            rss = 0
+            for proc in procs:
+                try:
+                    rss += proc.memory_info().rss
+                except psutil.Error:
+                    pass
+        except psutil.Error:
+            return
+        worker['rss'] = rss
+        worker['peak'] = max(worker['peak'], rss)
+
+    def collect(self, worker):
+        src = worker['src']
+        worker['src'] = None
+        try:
+            result, rss = worker['conn'].recv()
+        except (EOFError, OSError):
+            # The worker died, possibly killed for using too much memory
+            if worker['peak']:
+                self.peaks.append(worker['peak'])
+            self.stop_worker(worker)
+            return src, None
+        self.peaks.append(max(worker['peak'], rss))
+        if rss > self.leak_limit:
+            if self.verbose >= 2:
+                sys.stderr.write('Recycling worker using %3.1f GB\n' % (rss / 1024 ** 3))
+                sys.stderr.flush()
+            self.stop_worker(worker)
+        return src, result
+
+
+def ocr_worker(conn, literals):
+    # The matcher is built here rather than inherited so that it doesn't
+    # depend on how the worker process was started.
+    worker_matcher = phi_matcher.PHIMatcher(user_patterns.split('\n'), literals)
+    while True:
+        try:
+            src = conn.recv()
+        except EOFError:
+            break
+        if src is None:
+            break
+        try:
+            result = ocr_image(src, worker_matcher)
+        except Exception:
+            result = None
+        conn.send((result, psutil.Process().memory_info().rss))
 
 
 def ocr_images(args):
     meta = {}
     if args.collection and os.path.exists(args.collection):
         meta = json.load(open(args.collection))
-    max_workers = psutil.virtual_memory().total // (4 * 1024 ** 3)
-    max_workers = min(max_workers, multiprocessing.cpu_count())
-    max_workers = max(1, max_workers)
-    if args.verbose >= 2:
-        sys.stderr.write('Worker pool: %d\n' % max_workers)
-        sys.stderr.flush()
-    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
-        tasks = [(src, pool.submit(ocr_image, src)) for src in args.source]
-        while len(tasks):
-            try:
-                result = tasks[0][-1].result(0.1)
-            except concurrent.futures.TimeoutError:
-                continue
-            src, task = tasks.pop(0)
-            if args.verbose:
-                sys.stderr.write('%s\n' % src)
+    if args.memory:
+        memory_budget = args.memory * 1024 ** 3
+    else:
+        memory_budget = psutil.virtual_memory().available * 0.8
+    pool = AdaptivePool(
+        memory_budget, multiprocessing.cpu_count(), args.worker_memory * 1024 ** 3,
+        verbose=args.verbose,
+        literals=phi_matcher.read_lines(args.literals) if args.literals else ())
+    for src, result in pool.run(args.source):
+        if args.verbose:
+            sys.stderr.write('%s\n' % src)
+            sys.stderr.flush()
+        if not result:
+            continue
+        for key, (text, confidence) in result.items():
+            filename = os.path.basename(src)
+            meta.setdefault(filename, {})
+            if meta[filename].get(key) != text:
+                meta[filename][key] = (
+                    meta[filename][key] + '\n' if key in meta[filename] else '') + text
+            if args.confidence:
+                meta[filename]['%s confidence' % key] = {
+                    word: round(score, 3) for word, score in confidence.items()}
+            if args.verbose >= 2:
+                sys.stderr.write('  %s: %s\n' % (key, text))
                 sys.stderr.flush()
-            if not result:
-                continue
-            for key in result:
-                text = result[key]
-                filename = os.path.basename(src)
-                meta.setdefault(filename, {})
-                if meta[filename].get(key) != text:
-                    meta[filename][key] = (
-                        meta[filename][key] + '\n' if key in meta[filename] else '') + text
-                if args.verbose >= 2:
-                    sys.stderr.write('  %s: %s\n' % (key, text))
-                    sys.stderr.flush()
     if args.out:
         outptr = open(args.out, 'w')
     else:
@@ -152,42 +350,134 @@ def ocr_images(args):
     outptr.write(yaml.dump(meta))
     if args.collection:
         meta = json.dump(meta, open(args.collection, 'w'))
-    if args.verbose >= 3:
-        sys.stderr.write('  run time: %5.3fs\n' % (time.time() - start_time))
 
 
-def ocr_image(src):
-    result = {}
+def tiff_associated_pages(src):
+    """
+    Find the label, macro, and thumbnail IFDs of a TIFF file.
+
+    Returns a dictionary of associated image name to top-level IFD index, or
+    None if the file is not a TIFF or has no recognizable associated images.
+    """
     try:
-        ts = large_image.open(src)
+        with lazy_tiff.LazyTiff(src) as info:
+            pages = associated_pages(info['ifds'])
     except Exception:
-        return
-    proc_time = time.time()
-    for key in ts.getAssociatedImagesList():
-        try:
-            image, _ = ts.getAssociatedImage(key)
-        except Exception:
-            continue
+        return None
+    return pages or None
+
+
+def associated_pages(ifds):
+    pages = {}
+    for idx, ifd in enumerate(ifds):
+        ifd_type = get_ifd_type(ifd)
+        if ifd_type in associated_ifd_types:
+            pages.setdefault(ifd_type.value, idx)
+    return pages
+
+
+def vips_to_pil(image):
+    if image.format != 'uchar':
+        image = image.scaleimage()
+    mode = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}[image.bands]
+    return PIL.Image.frombuffer(
+        mode, (image.width, image.height), image.write_to_memory(), 'raw', mode, 0, 1)
+
+
+def tiff_associated_images(src, pages, errors=None):
+    for key, page in pages.items():
         try:
-            image = PIL.Image.open(io.BytesIO(image))
-            if False:
-                text = pytesseract.image_to_string(image, config=tesseract_config).strip()
-                text = ' '.join(text.split())
-            else:
-                text = get_text_from_image(image)
-            if text:
-                result[key] = text
-        except Exception:
+            image = pyvips.Image.tiffload(src, page=page, access='sequential')
+            image = vips_to_pil(image)
+        except Exception as exc:
+            if errors is not None:
+                errors[key] = repr(exc)
             continue
-    large_image.cache_util.cachesClear()
-    if args.verbose >= 3:
-        sys.stderr.write('  process time: %5.3fs\n' % (time.time() - proc_time))
+        yield key, image
+
+
+def large_image_associated_images(src, skip=(), errors=None):
+    try:
+        ts = large_image.open(src)
+    except Exception:
+        return
+    try:
+        for key in ts.getAssociatedImagesList():
+            if key in skip:
+                continue
+            try:
+                image, _ = ts.getAssociatedImage(key)
+                image = PIL.Image.open(io.BytesIO(image))
+            except Exception as exc:
+                if errors is not None:
+                    errors[key] = repr(exc)
+                continue
+            yield key, image
+    finally:
+        large_image.cache_util.cachesClear()
+
+
+def needs_large_image(found):
+    """
+    Return whether to ask large_image for the associated images that a TIFF
+    scan didn't find.  Many pyramids have no separate thumbnail, so a missing
+    thumbnail alone isn't worth opening the file again.
+    """
+    return not {IFDType.label.value, IFDType.macro.value}.issubset(found)
+
+
+def associated_images(src, errors=None):
+    """
+    Yield (name, PIL image) for each associated image of a file.
+
+    Label, macro, and thumbnail IFDs of TIFF files are read directly.  If the
+    label or macro isn't found that way, such as in non-TIFF formats or TIFFs
+    that don't mark them with NewSubfileType, large_image is asked for the
+    images that are still missing.
+
+    If errors is a dictionary, the images that exist but could not be decoded
+    either way are added to it as name to error once the images have all been
+    yielded.
+    """
+    found = set()
+    failed = {}
+    pages = tiff_associated_pages(src)
+    if pages is not None:
+        for key, image in tiff_associated_images(src, pages, failed):
+            found.add(key)
+            yield key, image
+    if needs_large_image(found):
+        for key, image in large_image_associated_images(src, found, failed):
+            found.add(key)
+            yield key, image
+    if errors is not None:
+        errors.update((key, error) for key, error in failed.items() if key not in found)
+
+
+def ocr_image(src, matcher=matcher):
+    result = {}
+    with metrics.span('ocr_image', file=src):
+        for key, image in associated_images(src):
+            metrics.count('images')
+            try:
+                if False:
+                    text = pytesseract.image_to_string(image, config=tesseract_config).strip()
+                    metrics.count('ocr_calls')
+                    text = ' '.join(text.split())
+                    confidence = {}
+                else:
+                    text, confidence = get_text_from_image(image, matcher)
+                if text:
+                    result[key] = (text, confidence)
+            except Exception:
+                continue
     return result
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
-        description='OCR all associated images from files that can be opened with large_image.')
+        description='OCR all associated images from TIFF files or files that can be opened '
+        'with large_image.')
     parser.add_argument(
         'source', nargs='+', help='Source file.')
     parser.add_argument(
@@ -198,7 +488,28 @@ if __name__ == '__main__':
         '--out',
         help='If specified, output the results to this text file.  Otherwise, '
         'output to stdout.')
+    parser.add_argument(
+        '--literals',
+        help='A file of literal strings, one per line, such as names.  End a '
+        'line with * to match it as a prefix, such as for MRNs.  OCR results '
+        'that contain these are preferred, as are results that match the '
+        'tesseract user patterns.')
+    parser.add_argument(
+        '--confidence', action='store_true',
+        help='Also output the fraction of OCR variants that agree on each '
+        'word of the reported text.')
+    parser.add_argument(
+        '--memory', type=float,
+        help='Memory budget in GB for all OCR workers.  Defaults to 80%% of '
+        'the available memory.')
+    parser.add_argument(
+        '--worker-memory', type=float, default=2,
+        help='Replace a worker if its resident memory exceeds this many GB '
+        'after finishing a file.')
     parser.add_argument(
         '--verbose', '-v', action='count', default=0, help='Increase output.')
+    metrics.add_arguments(parser)
     args = parser.parse_args()
-    ocr_images(args)
+    metrics.configure_from_args(args, echo=args.verbose >= 3)
+    with metrics.span('ocr_images'):
+        ocr_images(args)
@@ -0,0 +1,258 @@
+import bisect
+import re
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+# Patterns use the tesseract user-patterns language:
+# \c - alpha (regex [a-zA-Z], except adds unicode)
+# \d - digit (regex \d)
+# \n - digit or alpha (regex \w without _)
+# \p - punctuation (regex [^\w\s])
+# \a - lower alpha (regex [a-z])
+# \A - upper alpha (regex [A-Z])
+# \* can repeat previous character (regex *)
+default_patterns = """TCGA-\\n\\n-\\n\\n\\n\\n-\\d\\d\\n-\\d\\d-\\n\\n\\d
+TCGA-\\n\\n-\\n\\n\\n\\n-\\d\\d\\n
+\\d\\d/\\d\\d/\\d\\d
+\\d/\\d\\d/\\d\\d
+\\d\\d/\\d/\\d\\d
+\\d/\\d/\\d\\d
+"""
+
+WORD_RE = re.compile(r'\w+')
+WORD_TAIL_RE = re.compile(r'\w*')
+
+tesseract_classes: Dict[str, str] = {
+    'c': r'[^\W\d_]',
+    'd': r'\d',
+    'n': r'[^\W_]',
+    'p': r'[^\w\s]',
+    'a': r'[a-z]',
+    'A': r'[A-Z]',
+}
+
+
+class PHIMatch(NamedTuple):
+    source: str
+    text: str
+    start: int
+    end: int
+
+
+def tesseract_elements(pattern: str) -> List[Tuple[str, Optional[str]]]:
+    """
+    Split a tesseract user pattern into (regular expression, literal
+    character or None) elements, one per character it matches, plus '*'
+    elements for repeats.
+    """
+    elements: List[Tuple[str, Optional[str]]] = []
+    idx = 0
+    while idx < len(pattern):
+        char = pattern[idx]
+        if char == '\\' and idx + 1 < len(pattern):
+            code = pattern[idx + 1]
+            idx += 2
+            if code in tesseract_classes:
+                elements.append((tesseract_classes[code], None))
+            elif code == '*' and elements:
+                elements.append(('*', None))
+            else:
+                elements.append((re.escape(code), code))
+        else:
+            elements.append((re.escape(char), char))
+            idx += 1
+    return elements
+
+
+def tesseract_to_re(pattern: str) -> str:
+    """Convert a tesseract user pattern to a regular expression."""
+    return ''.join(expr for expr, _ in tesseract_elements(pattern))
+
+
+def read_lines(path: str) -> List[str]:
+    """Read the non-blank lines of a pattern or literal file."""
+    with open(path) as fptr:
+        return [line.strip() for line in fptr if line.strip()]
+
+
+class PatternRule(NamedTuple):
+    """A compiled tesseract pattern and the literal text every match contains."""
+    source: str
+    regex: 're.Pattern'
+    # The anchor is a literal run at a fixed offset from the start of every
+    # match, or None if the pattern has no such run.
+    anchor: Optional[str]
+    offset: int
+
+
+def pattern_rule(pattern: str) -> PatternRule:
+    """Compile a tesseract pattern and find its longest fixed-position literal run."""
+    elements = tesseract_elements(pattern)
+    regex = re.compile(''.join(expr for expr, _ in elements))
+    best: Tuple[str, int] = ('', 0)
+    run, start = '', 0
+    for pos, (expr, char) in enumerate(elements + [('', None)]):
+        if char is not None:
+            if not run:
+                start = pos
+            run += char
+            continue
+        if expr == '*':
+            # The repeated element may not be present at all
+            run = run[:-1]
+        if len(run) > len(best[0]):
+            best = (run, start)
+        run = ''
+        if expr == '*':
+            # Nothing after a repeat is at a fixed offset
+            break
+    return PatternRule(pattern, regex, best[0] or None, best[1])
+
+
+def is_word_char(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+
+class PHIMatcher:
+    """
+    A compiled matcher for tesseract-style patterns and literal dictionaries.
+
+    Literals (such as names) are matched case-insensitively on word
+    boundaries; a literal ending in * (such as an MRN prefix) only needs to
+    start a word.  Rather than searching for every literal, the text is split
+    into its set of distinct words once, and only literals whose words all
+    occur are located.
+
+    Patterns are located by their longest literal run (such as the / of a
+    date): the pattern is only tried where that run occurs.  Patterns made
+    only of character classes are searched for everywhere.
+    """
+
+    def __init__(self, patterns: Iterable[str] = (), literals: Iterable[str] = ()):
+        self.patterns = [pat.strip() for pat in patterns if pat.strip()]
+        self.rules = [pattern_rule(pat) for pat in self.patterns]
+        # Literals are indexed by their last word, or, for prefixes, by the
+        # length and text of the partial word they end with.
+        self.words: Dict[str, List[Tuple[str, List[str]]]] = {}
+        self.prefixes: Dict[int, Dict[str, List[Tuple[str, List[str]]]]] = {}
+        for lit in {lit.strip().lower() for lit in literals if lit.strip()}:
+            prefix = lit.endswith('*')
+            lit = lit.rstrip('*')
+            words = WORD_RE.findall(lit)
+            if not words:
+                continue
+            if prefix:
+                self.prefixes.setdefault(len(words[-1]), {}).setdefault(
+                    words[-1], []).append((lit, words[:-1]))
+            else:
+                self.words.setdefault(words[-1], []).append((lit, words[:-1]))
+
+    def _literal_candidates(self, text: str) -> List[Tuple[str, str]]:
+        """List the (literal, source) pairs whose words all occur in a text."""
+        words = set()
+        for word in set(text.split()):
+            if word.isalnum():
+                words.add(word)
+            else:
+                words.update(WORD_RE.findall(word))
+        candidates = []
+        for word in words & self.words.keys():
+            candidates.extend(
+                (lit, 'literal') for lit, others in self.words[word] if words.issuperset(others))
+        for length, table in self.prefixes.items():
+            for start in {word[:length] for word in words if len(word) >= length} & table.keys():
+                candidates.extend(
+                    (lit, 'prefix') for lit, others in table[start] if words.issuperset(others))
+        return candidates
+
+    def _literal_matches(self, text: str) -> Iterator[PHIMatch]:
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            # Lowercasing changed some offsets; fall back to a regex for the
+            # few literals that can be present.
+            for lit, source in self._literal_candidates(lowered):
+                expr = r'(?<!\w)(?i:%s)' % re.escape(lit)
+                expr += r'\w*' if source == 'prefix' else r'(?!\w)'
+                for match in re.finditer(expr, text):
+                    yield PHIMatch(source, match.group(), match.start(), match.end())
+            return
+        # Literals that start with the same word are located together
+        groups: Dict[str, List[Tuple[str, str]]] = {}
+        for lit, source in self._literal_candidates(lowered):
+            groups.setdefault(lit[:WORD_RE.search(lit).end()], []).append((lit, source))
+        for group in groups.values():
+            # Prefer the longest literal starting at a position
+            group.sort(key=lambda item: -len(item[0]))
+        for key, group in groups.items():
+            pos = lowered.find(key)
+            while pos >= 0:
+                if not pos or not is_word_char(lowered[pos - 1]):
+                    for lit, source in group:
+                        if not lowered.startswith(lit, pos):
+                            continue
+                        end = pos + len(lit)
+                        if source == 'prefix':
+                            end = WORD_TAIL_RE.match(text, end).end()
+                        elif end < len(text) and is_word_char(lowered[end]):
+                            continue
+                        yield PHIMatch(source, text[pos:end], pos, end)
+                pos = lowered.find(key, pos + 1)
+
+    def _pattern_matches(self, text: str) -> Iterator[Tuple[int, PHIMatch]]:
+        anchored: Dict[str, List[Tuple[int, PatternRule]]] = {}
+        for order, rule in enumerate(self.rules):
+            if rule.anchor is None:
+                for match in rule.regex.finditer(text):
+                    yield order, PHIMatch(rule.source, match.group(), match.start(), match.end())
+            else:
+                anchored.setdefault(rule.anchor, []).append((order, rule))
+        for anchor, rules in anchored.items():
+            pos = text.find(anchor)
+            while pos >= 0:
+                for order, rule in rules:
+                    if pos >= rule.offset:
+                        match = rule.regex.match(text, pos - rule.offset)
+                        if match:
+                            yield order, PHIMatch(
+                                rule.source, match.group(), match.start(), match.end())
+                pos = text.find(anchor, pos + 1)
+
+    def finditer(self, text: str) -> Iterator[PHIMatch]:
+        """
+        Yield every non-overlapping match in a text in order.  Where matches
+        overlap, the one that starts first wins, then patterns in the order
+        given, then literals.
+        """
+        found = list(self._pattern_matches(text))
+        if self.words or self.prefixes:
+            found.extend((len(self.rules), match) for match in self._literal_matches(text))
+        found.sort(key=lambda item: (item[1].start, item[0]))
+        end = 0
+        for _, match in found:
+            if match.start >= end:
+                end = match.end
+                yield match
+
+    def search(self, text: str) -> Optional[PHIMatch]:
+        """Return the first match in a text or None."""
+        return next(self.finditer(text), None)
+
+    def scan(self, items: Iterable[Tuple[str, str]]) -> Iterator[Tuple[str, str, PHIMatch]]:
+        """
+        Scan many (key, value) pairs in one pass.
+
+        The values are joined with newlines, which no pattern can match, and
+        each match is mapped back to the pair it came from.  Yields
+        (key, value, match) with match offsets relative to the value.
+        """
+        items = list(items)
+        starts: List[int] = []
+        pos = 0
+        for _, value in items:
+            starts.append(pos)
+            pos += len(value) + 1
+        text = '\n'.join(value for _, value in items)
+        for match in self.finditer(text):
+            idx = bisect.bisect_right(starts, match.start) - 1
+            key, value = items[idx]
+            yield key, value, match._replace(
+                start=match.start - starts[idx], end=match.end - starts[idx])
@@ -0,0 +1,254 @@
+import argparse
+import concurrent.futures
+import functools
+import json
+import os
+import sys
+
+import large_image
+import pyvips
+import yaml
+
+import img_set
+import lazy_tiff
+import list_metadata
+import metrics
+import ocr_images
+import phi_matcher
+import redact_image
+from redact_image import IFDType, get_ifd_type
+
+
+def process_slide(src, args):
+    """
+    Run each enabled stage on one slide, reading its TIFF structure once.
+
+    The parsed IFDs are shared by the metadata census, thumbnail extraction,
+    and redaction.  Only the associated images the enabled stages use are
+    decoded, and the macro image is decoded once for both OCR and the image
+    set.  Files that are not TIFFs only get OCR and images through
+    large_image.
+
+    Returns a dictionary with the results that are merged across slides:
+    'meta' (metadata value counts) and 'ocr' (associated image name to text),
+    and 'image_errors' (associated image name to error) for associated
+    images that could not be read or OCRed.
+    """
+    errors = {}
+    result = {'image_errors': errors}
+    run_ocr = args.ocr or args.ocr_collection
+    destroot = os.path.join(args.images, os.path.basename(src)) if args.images else None
+    try:
+        tiff = lazy_tiff.LazyTiff(src)
+    except Exception:
+        if run_ocr:
+            result['ocr'] = ocr_text(
+                ocr_sources(src, {}, errors), ocr_matcher(args.literals), errors)
+        if args.images:
+            img_set.save_large_image_images(src, destroot)
+        return result
+    with tiff as info:
+        ifds = info['ifds']
+        if args.metadata:
+            with metrics.span('metadata', file=src):
+                meta = list_metadata.flatten(ifds)
+                meta = list_metadata.unjson(meta)
+                meta = list_metadata.check_aperio(meta)
+                meta = list_metadata.check_hamamatsu(meta)
+                meta = list_metadata.check_imagej(meta)
+            result['meta'] = meta
+        pages = ocr_images.associated_pages(ifds) if run_ocr or args.images else {}
+        if not run_ocr:
+            # The image set only uses the macro image
+            pages = {key: page for key, page in pages.items() if key == 'macro'}
+        associated = {}
+        for key, page in pages.items():
+            try:
+                image = pyvips.Image.tiffload(src, page=page, access='sequential')
+                if run_ocr and args.images and key == 'macro':
+                    # Used twice, so keep the decoded pixels
+                    image = image.copy_memory()
+                associated[key] = image
+            except Exception as exc:
+                errors[key] = repr(exc)
+        if run_ocr:
+            with metrics.span('ocr', file=src):
+                result['ocr'] = ocr_text(
+                    ocr_sources(src, associated, errors), ocr_matcher(args.literals), errors)
+        if args.redact:
+            annotation = os.path.join(args.annotations, os.path.basename(src) + '.json')
+            dest = os.path.join(args.redact, os.path.basename(src))
+            if os.path.exists(annotation) and os.path.abspath(dest) != os.path.abspath(src):
+                with metrics.span('redact', file=src):
+                    lazy_tiff.load_tags(ifds)
+                    redact_image.redact_tiff(
+                        src, dest, redact_image.get_polygons(annotation), False,
+                        original_info=info)
+        if args.images:
+            with metrics.span('images', file=src):
+                if not save_images(src, destroot, ifds, associated, errors):
+                    return result
+            # Skip tile offsets and byte counts
+            lazy_tiff.load_tags(ifds, skip=img_set.SKIP_TAGS)
+    if args.images:
+        img_set.write_json(info, destroot)
+    return result
+
+
+@functools.lru_cache(maxsize=1)
+def ocr_matcher(literals_path):
+    literals = phi_matcher.read_lines(literals_path) if literals_path else ()
+    return phi_matcher.PHIMatcher(ocr_images.user_patterns.split('\n'), literals)
+
+
+def ocr_sources(src, associated, errors):
+    """
+    Yield (name, PIL image) for each associated image to OCR.
+
+    These are the images already loaded from the TIFF IFDs followed, as with
+    ocr_images.associated_images, by any that large_image finds when the label
+    or macro wasn't loaded.  Images that can't be decoded are added to errors.
+    """
+    found = set()
+    for key, image in associated.items():
+        try:
+            image = ocr_images.vips_to_pil(image)
+        except Exception as exc:
+            errors[key] = repr(exc)
+            continue
+        found.add(key)
+        yield key, image
+    if ocr_images.needs_large_image(found):
+        for key, image in ocr_images.large_image_associated_images(src, found, errors):
+            found.add(key)
+            errors.pop(key, None)
+            yield key, image
+
+
+def ocr_text(images, matcher, errors):
+    result = {}
+    for key, image in images:
+        try:
+            text, _ = ocr_images.get_text_from_image(image, matcher)
+        except Exception as exc:
+            errors[key] = repr(exc)
+            continue
+        if text:
+            result[key] = text
+    return result
+
+
+def save_images(src, destroot, ifds, associated, errors):
+    level = img_set.pick_level(ifds, img_set.SMALL_SIZE)
+    if level is None or not img_set.save_small_image(src, destroot, level):
+        return img_set.save_large_image_images(src, destroot)
+    if 'macro' in associated:
+        try:
+            img_set.save_jpeg(associated['macro'], destroot + '_macro.jpg', 95)
+        except Exception as exc:
+            errors['macro'] = repr(exc)
+    elif not any(get_ifd_type(ifd) == IFDType.macro for ifd in ifds):
+        try:
+            img_set.save_large_image_macro(large_image.open(src), destroot)
+        except Exception:
+            pass
+    return True
+
+
+def run_slides(pool, args, limit):
+    """
+    Submit slides to a pool with at most limit in flight.  Yields (source,
+    future) as each slide finishes.
+    """
+    pending = {}
+    for src in args.source:
+        if len(pending) >= limit:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future
+        pending[pool.submit(process_slide, src, args)] = src
+    for future in concurrent.futures.as_completed(pending):
+        yield pending[future], future
+
+
+def process_slides(args):
+    files = list_metadata.read_collection(args.metadata)
+    ocr = list_metadata.read_json(args.ocr_collection)
+    for path in (args.images, args.redact):
+        if path:
+            os.makedirs(path, exist_ok=True)
+    workers = args.workers or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for src, future in run_slides(pool, args, workers * 2):
+            try:
+                result = future.result()
+            except Exception as exc:
+                sys.stderr.write('%s: failed: %r\n' % (src, exc))
+                continue
+            if args.verbose:
+                sys.stderr.write('%s\n' % src)
+                sys.stderr.flush()
+            for key, error in result.get('image_errors', {}).items():
+                metrics.count('image_errors')
+                sys.stderr.write('%s: %s: failed: %s\n' % (src, key, error))
+                sys.stderr.flush()
+            if 'meta' in result:
+                files[os.path.abspath(src)] = result['meta']
+            for key, text in result.get('ocr', {}).items():
+                # Merge as ocr_images.py --collection does
+                texts = ocr.setdefault(os.path.basename(src), {})
+                if texts.get(key) != text:
+                    texts[key] = (texts[key] + '\n' if key in texts else '') + text
+    if args.metadata:
+        list_metadata.write_collection(args.metadata, files)
+    if args.ocr:
+        open(args.ocr, 'w').write(yaml.dump(ocr))
+    if args.ocr_collection:
+        json.dump(ocr, open(args.ocr_collection, 'w'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run the metadata census, label and macro OCR, thumbnail '
+        'extraction, and redaction over slides, reading each slide once.  '
+        'Only the stages with an output are run.')
+    parser.add_argument(
+        'source', nargs='+', help='Source file.')
+    parser.add_argument(
+        '--metadata',
+        help='A file path to read and write collected metadata, as with '
+        'list_metadata.py --collection.')
+    parser.add_argument(
+        '--ocr',
+        help='A file to write the OCR results to as yaml.')
+    parser.add_argument(
+        '--ocr-collection',
+        help='A file path to read and write collected OCR results, as with '
+        'ocr_images.py --collection.')
+    parser.add_argument(
+        '--literals',
+        help='A file of literal strings, one per line, such as names, as with '
+        'ocr_images.py --literals.  OCR results that contain these are '
+        'preferred.')
+    parser.add_argument(
+        '--images',
+        help='A directory for low resolution images, macro images, and '
+        'tifftools data, as with img_set.py.')
+    parser.add_argument(
+        '--redact',
+        help='A directory for redacted slides.  Only slides with an '
+        'annotation file are redacted.')
+    parser.add_argument(
+        '--annotations', default='.',
+        help='A directory with annotation files named <slide file name>.json.')
+    parser.add_argument(
+        '--workers', type=int,
+        help='Number of worker processes.  Defaults to the number of CPUs.')
+    parser.add_argument(
+        '--verbose', '-v', action='count', default=0, help='Increase output.')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure_from_args(args)
+    with metrics.span('process_slides'):
+        process_slides(args)
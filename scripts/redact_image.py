@@ -2,13 +2,14 @@ import argparse
 import copy
 import dataclasses
 import enum
+import io
 import json
 import os
 import re
 import struct
 import sys
 import tempfile
-from typing import Any, BinaryIO, Dict, List
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
 
 import pyvips
 from tifftools.constants import (
@@ -16,6 +17,7 @@ from tifftools.constants import (
     Datatype,
     EstimateJpegQuality,
     Photometric,
+    Predictor,
     Tag,
     TiffConstant,
     TiffConstantSet,
@@ -24,6 +26,37 @@ from tifftools.constants import (
 from tifftools.path_or_fobj import OpenPathOrFobj
 from tifftools.tifftools import check_offset, read_tiff, write_ifd, write_tag_data
 
+import metrics
+
+# Compressions that thumbnails can be re-encoded with, as tiffsave names
+THUMBNAIL_COMPRESSION = {
+    Compression['None'].value: 'none',
+    Compression.LZW.value: 'lzw',
+    Compression.JPEG.value: 'jpeg',
+    Compression.AdobeDeflate.value: 'deflate',
+    Compression.Deflate.value: 'deflate',
+    Compression.Packbits.value: 'packbits',
+    Compression.ZSTD.value: 'zstd',
+    Compression.WEBP.value: 'webp',
+}
+THUMBNAIL_PREDICTOR = {
+    Predictor['None'].value: 'none',
+    Predictor.Horizontal.value: 'horizontal',
+    Predictor.FloatingPoint.value: 'float',
+}
+# Tags that describe how a thumbnail's strips are encoded.  When a thumbnail
+# is re-encoded with a different compression, these come from the new
+# encoding, and any the new encoding doesn't have are dropped.
+THUMBNAIL_ENCODING_TAGS = (
+    Tag.Compression, Tag.Photometric, Tag.BitsPerSample, Tag.SamplesPerPixel,
+    Tag.SampleFormat, Tag.PlanarConfig, Tag.ExtraSamples, Tag.FillOrder,
+    Tag.Predictor, Tag.JPEGTables, Tag.YCbCrSubsampling, Tag.YCbCrPositioning,
+    Tag.YCbCrCoefficients, Tag.ReferenceBlackWhite, Tag.T4Options, Tag.T6Options,
+    Tag.JPEGProc, Tag.JPEGIFOffset, Tag.JPEGIFByteCount, Tag.JPEGRestartInterval,
+    Tag.JPEGLosslessPredictors, Tag.JPEGPointTransform, Tag.JPEGQTables,
+    Tag.JPEGDCTables, Tag.JPEGACTables,
+)
+
 
 @dataclasses.dataclass
 class Polygon:
@@ -79,9 +112,19 @@ def get_ifd_type(ifd: Dict[str, Any]) -> IFDType:
         return IFDType.other
 
 
-def create_svg(width: int, height: int, polygons: List[Polygon]) -> pyvips.Image:
-    """Create an SVG image using polygons."""
-    svg_str = f'<svg viewBox="0 0 {width} {height}" xmlns="http://www.w3.org/2000/svg">'
+def create_svg(
+    width: int, height: int, polygons: List[Polygon], size: Optional[Tuple[int, int]] = None
+) -> pyvips.Image:
+    """
+    Create an SVG image using polygons.
+
+    If size is given, the polygons are drawn directly at that (width, height)
+    rather than at the full resolution.
+    """
+    svg_str = f'<svg viewBox="0 0 {width} {height}" xmlns="http://www.w3.org/2000/svg"'
+    if size:
+        svg_str += f' width="{size[0]}" height="{size[1]}" preserveAspectRatio="none"'
+    svg_str += '>'
 
     for polygon in polygons:
         if isinstance(polygon.points[0][0], list):
@@ -373,13 +416,110 @@ def write_tag_data_conditionally(
                 data = src.read(min(length, COPY_CHUNKSIZE))
                 dest.write(data)
                 length -= len(data)
+                metrics.count('bytes_read', len(data))
 
     return destOffsets
 
 
-def redact_tiff(input_filename: str, output_filename: str, polygons: List[Polygon], verbose: bool):
-    """Remove polygons from input TIFF and output a modified redacted TIFF."""
-    original_info = read_tiff(input_filename)
+def redact_thumbnail(
+    input_filename: str,
+    page: int,
+    original_ifd: Dict[str, Any],
+    width: int,
+    height: int,
+    polygons: List[Polygon],
+) -> Dict[str, Any]:
+    """
+    Redact a stripped thumbnail IFD in memory.
+
+    The polygons are drawn at the thumbnail's size.  If none of them reach
+    the thumbnail, the original IFD is returned.  Otherwise the thumbnail is
+    encoded once with its original compression, predictor, and rows per
+    strip, and the returned IFD has the original tags with only the strip
+    data (and JPEG tables) replaced.  A thumbnail with a compression that
+    can't be written is stored without compression, and its encoding tags
+    are replaced too.
+    """
+    tags = original_ifd['tags']
+    thumbnail_width = tags[Tag.ImageWidth.value]['data'][0]
+    thumbnail_height = tags[Tag.ImageHeight.value]['data'][0]
+    mask = create_svg(width, height, polygons, (thumbnail_width, thumbnail_height))
+    if not mask.extract_band(3).max():
+        return original_ifd
+
+    # A cached load of a stripped image can't be read from the start again,
+    # so don't reuse one from an earlier call.
+    original_image = pyvips.Image.tiffload(input_filename, page=page, revalidate=True)
+    redacted_image = original_image.composite2(mask, pyvips.BlendMode.OVER)
+    # Thumbnails are small; keep the result in memory so a failed encode can
+    # be retried without decoding again.
+    redacted_image = redacted_image.extract_band(0, n=original_image.bands).cast(
+        original_image.format).copy_memory()
+
+    compression = tags[Tag.Compression.value]['data'][0] if Tag.Compression.value in tags else 1
+    options: Dict[str, Any] = {'compression': THUMBNAIL_COMPRESSION.get(compression, 'none')}
+    if options['compression'] == 'jpeg':
+        options['rgbjpeg'] = tags[Tag.Photometric.value]['data'][0] == Photometric.RGB.value
+        if Tag.JPEGTables.value in tags:
+            tables = tags[Tag.JPEGTables.value]['data']
+        else:
+            # Each strip is a complete JPEG; its quantization tables are near
+            # the start.
+            with open(input_filename, 'rb') as fptr:
+                fptr.seek(tags[Tag.StripOffsets.value]['data'][0])
+                tables = fptr.read(min(tags[Tag.StripByteCounts.value]['data'][0], 4096))
+        options['Q'] = EstimateJpegQuality(tables) or 90
+    elif options['compression'] in {'lzw', 'deflate', 'zstd'}:
+        predictor = tags[Tag.Predictor.value]['data'][0] if Tag.Predictor.value in tags else 1
+        options['predictor'] = THUMBNAIL_PREDICTOR.get(predictor, 'none')
+    rows = (tags[Tag.RowsPerStrip.value]['data'][0]
+            if Tag.RowsPerStrip.value in tags else thumbnail_height)
+    try:
+        data = redacted_image.tiffsave_buffer(
+            tile=False, tile_height=min(rows, thumbnail_height), pyramid=False,
+            bigtiff=True, **options)
+    except pyvips.Error:
+        # JPEG strips must be a multiple of 8 or 16 rows; use one strip.
+        data = redacted_image.tiffsave_buffer(
+            tile=False, tile_height=thumbnail_height, pyramid=False, bigtiff=True, **options)
+    redacted_ifd = read_tiff(io.BytesIO(data))['ifds'][0]
+
+    ifd = original_ifd.copy()
+    ifd['tags'] = tags.copy()
+    ifd['path_or_fobj'] = redacted_ifd['path_or_fobj']
+    ifd['size'] = redacted_ifd['size']
+    for tag in (Tag.StripOffsets, Tag.StripByteCounts, Tag.JPEGTables):
+        if tag.value in redacted_ifd['tags']:
+            ifd['tags'][tag.value] = redacted_ifd['tags'][tag.value]
+    for tag in (Tag.RowsPerStrip, Tag.YCbCrSubsampling):
+        if tag.value in tags and tag.value in redacted_ifd['tags']:
+            ifd['tags'][tag.value] = redacted_ifd['tags'][tag.value]
+    if compression not in THUMBNAIL_COMPRESSION:
+        # Re-encoded without compression, so the original pixel layout and
+        # compression-specific tags, such as old-style JPEG offsets, no
+        # longer apply.
+        for tag in THUMBNAIL_ENCODING_TAGS:
+            if tag.value in redacted_ifd['tags']:
+                ifd['tags'][tag.value] = redacted_ifd['tags'][tag.value]
+            else:
+                ifd['tags'].pop(tag.value, None)
+    return ifd
+
+
+def redact_tiff(
+    input_filename: str,
+    output_filename: str,
+    polygons: List[Polygon],
+    verbose: bool,
+    original_info: Optional[Dict[str, Any]] = None,
+):
+    """
+    Remove polygons from input TIFF and output a modified redacted TIFF.
+
+    If the TIFF has already been read, pass its info as original_info.
+    """
+    if original_info is None:
+        original_info = read_tiff(input_filename)
     original_ifds = original_info['ifds']
     width = original_ifds[0]['tags'][Tag.ImageWidth.value]['data'][0]
     height = original_ifds[0]['tags'][Tag.ImageHeight.value]['data'][0]
@@ -480,10 +620,15 @@ def redact_tiff(input_filename: str, output_filename: str, polygons: List[Polygo
                             print('cannot use conditional tiles')
                             print('writing to output image')
                         ifdPtr = write_ifd(dest, bom, True, redacted_ifd, ifdPtr)
+                        tiles = len(original_ifd['tags'][Tag.TileOffsets.value]['data'])
+                        metrics.count('tiles', tiles)
+                        metrics.count('tiles_redacted', tiles)
                     else:
                         if verbose:
                             print('using conditional tiles')
                         is_redacted = redacted_list(svg_image, original_ifd)
+                        metrics.count('tiles', len(is_redacted))
+                        metrics.count('tiles_redacted', sum(is_redacted))
                         modified_ifd = conditional_ifd(original_ifd, redacted_ifd, is_redacted)
                         # construct combined ifd
                         if verbose:
@@ -498,42 +643,13 @@ def redact_tiff(input_filename: str, output_filename: str, polygons: List[Polygo
                             ifdPtr=ifdPtr,
                         )
             elif ifd_type == IFDType.thumbnail:
-                # extract original image ifd properties
-                original_image_width = original_ifd['tags'][Tag.ImageWidth.value]['data'][0]
-                original_image_height = original_ifd['tags'][Tag.ImageHeight.value]['data'][0]
-
-                # create redacted image
-                original_image = pyvips.Image.tiffload(input_filename, page=i)
-                if (original_image_width, original_image_height) != (width, height):
-                    resized_svg = svg_image.resize(original_image_width / width)
-                else:
-                    resized_svg = svg_image
-                redacted_image = original_image.composite([resized_svg], pyvips.BlendMode.OVER)
-
-                with tempfile.NamedTemporaryFile(suffix=f'{i}_out.tiff') as tmp:
-                    # write redacted image to temporary file
-                    if verbose:
-                        print('creating redacted image')
-                    redacted_image.tiffsave(
-                        tmp.name,
-                        tile=False,
-                        pyramid=False,
-                        bigtiff=True,
-                    )
-
-                    # extract redacted image ifd properties
-                    redacted_info = read_tiff(tmp.name)
-                    redacted_ifd = redacted_info['ifds'][0]
-
-                    # write missing tags
-                    for tag in original_ifd['tags'].keys():
-                        if tag not in redacted_ifd['tags']:
-                            redacted_ifd['tags'][tag] = original_ifd['tags'][tag]
-
-                    # construct combined ifd
-                    if verbose:
-                        print('writing to output image')
-                    ifdPtr = write_ifd(dest, bom, True, redacted_ifd, ifdPtr)
+                if verbose:
+                    print('redacting thumbnail')
+                redacted_ifd = redact_thumbnail(
+                    input_filename, i, original_ifd, width, height, polygons)
+                if verbose:
+                    print('writing to output image')
+                ifdPtr = write_ifd(dest, bom, True, redacted_ifd, ifdPtr)
             else:
                 if verbose:
                     print('writing to output image')
@@ -546,6 +662,7 @@ def get_args():
     parser.add_argument('--out', '-o', type=str, required=True, help='Output image filename')
     parser.add_argument('--annotation', '-a', type=str, required=True, help='Annotation filename')
     parser.add_argument('--verbose', '-v', action='store_true', help='Verbose output')
+    metrics.add_arguments(parser)
     return parser.parse_args()
 
 
@@ -558,8 +675,10 @@ def main(args):
     if input_filename == output_filename:
         sys.exit('error: output filename cannot be the same as the source filename')
 
+    metrics.configure_from_args(args)
     polygons = get_polygons(annotation_filename)
-    redact_tiff(input_filename, output_filename, polygons, verbose)
+    with metrics.span('redact_tiff', file=input_filename):
+        redact_tiff(input_filename, output_filename, polygons, verbose)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,322 @@
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import json
+import os
+import sys
+
+import list_metadata
+import metrics
+import ocr_images
+import phi_matcher
+import redact_image
+
+# These match the folders of the Redaction collection in
+# devops/ImageDePHI/provision.yaml.
+FOLDERS = ['Unprocessed', 'Redacted', 'Processed', 'Original', 'Excluded', 'Quarantine']
+STAGES = ['metadata', 'ocr', 'redact']
+
+
+@functools.lru_cache(maxsize=4)
+def get_matcher(patterns, literals):
+    return phi_matcher.PHIMatcher(patterns, literals)
+
+
+def scan_metadata(path, patterns, literals):
+    """
+    Return whether a file is a readable TIFF and any metadata values that
+    look like PHI as (key, value, matched text) lists.
+    """
+    meta = list_metadata.file_metadata(path)
+    if meta is None:
+        return False, []
+    matcher = get_matcher(patterns, literals)
+    return True, [[key, value, match.text] for key, value, match in matcher.scan(
+        (key, value) for key, values in meta.items() for value in values)]
+
+
+def scan_ocr(path, patterns, literals):
+    """
+    OCR the associated images of a file.  Returns the text of each image, any
+    PHI found in it as (image name, matched text) lists, and the images that
+    could not be decoded or read as (image name, error) lists.
+    """
+    matcher = get_matcher(patterns, literals)
+    texts = {}
+    found = []
+    errors = {}
+    for key, image in ocr_images.associated_images(path, errors):
+        try:
+            text, _ = ocr_images.get_text_from_image(image, matcher)
+        except Exception as exc:
+            errors[key] = repr(exc)
+            continue
+        if text:
+            texts[key] = text
+            found.extend([key, match.text] for match in matcher.finditer(text))
+    return texts, found, [[key, error] for key, error in errors.items()]
+
+
+def redact_slide(path, annotation, dest):
+    redact_image.redact_tiff(path, dest, redact_image.get_polygons(annotation), False)
+
+
+class WatchFolder:
+    """
+    Move slides dropped in Unprocessed through the redaction workflow.
+
+    Each new slide is scanned for PHI in its metadata and in the OCR of its
+    associated images, then:
+    - slides that are not readable TIFFs go to Excluded;
+    - slides with possible PHI, or with associated images that could not be
+      read, go to Quarantine, since redaction copies the label, macro, and
+      metadata unchanged;
+    - other slides with an annotation are redacted into Redacted, and the
+      source is moved to Original;
+    - other slides stay in Unprocessed until an annotation is added, since
+      Redacted only holds redacted slides waiting for approval.  They are not
+      scanned again unless they change.
+    A <slide>.report.json with the findings is written next to the result.
+    An annotation in Unprocessed is moved along with its slide.
+
+    The default patterns include dates, which match the Date field that every
+    Aperio SVS file has, so SVS files are always quarantined unless metadata
+    is scanned with other patterns (--metadata-patterns).
+
+    Each stage runs on its own process pool, and at most a fixed number of
+    slides are queued or in progress; the watcher stops picking up new files
+    while the queue is full.  Files are only written to their final names by
+    renaming, so nothing watching the folders sees a partial file.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.folders = {name: os.path.join(args.root, name) for name in FOLDERS}
+        for folder in self.folders.values():
+            os.makedirs(folder, exist_ok=True)
+        self.annotations = args.annotations or self.folders['Unprocessed']
+        self.patterns = tuple(phi_matcher.read_lines(args.patterns) if args.patterns else
+                              phi_matcher.default_patterns.split('\n'))
+        self.metadata_patterns = tuple(
+            phi_matcher.read_lines(args.metadata_patterns) if args.metadata_patterns else
+            self.patterns)
+        self.literals = tuple(phi_matcher.read_lines(args.literals) if args.literals else ())
+        workers = {
+            'metadata': args.metadata_workers,
+            'ocr': args.ocr_workers,
+            'redact': args.redact_workers,
+        }
+        self.pools = {
+            stage: concurrent.futures.ProcessPoolExecutor(workers[stage]) for stage in STAGES}
+        self.limits = {stage: asyncio.Semaphore(workers[stage]) for stage in STAGES}
+        self.queue = asyncio.Queue(args.queue)
+        self.pending = set()
+        # Scanned slides without an annotation: name to (identity, report)
+        self.waiting = {}
+
+    def log(self, level, msg):
+        if self.args.verbose >= level:
+            sys.stderr.write(msg + '\n')
+            sys.stderr.flush()
+
+    async def run(self):
+        slots = self.args.queue + sum(pool._max_workers for pool in self.pools.values())
+        workers = [asyncio.create_task(self.worker()) for _ in range(slots)]
+        try:
+            await self.watch()
+            await self.queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            for pool in self.pools.values():
+                pool.shutdown()
+
+    def list_unprocessed(self):
+        files = {}
+        with os.scandir(self.folders['Unprocessed']) as entries:
+            for entry in entries:
+                if (entry.name.startswith('.') or entry.name.endswith('.json') or
+                        not entry.is_file()):
+                    continue
+                stat = entry.stat()
+                files[entry.name] = (
+                    stat.st_size, stat.st_mtime_ns, self.annotation_identity(entry.name))
+        return files
+
+    def annotation_path(self, name):
+        return os.path.join(self.annotations, name + '.json')
+
+    def annotation_identity(self, name):
+        try:
+            stat = os.stat(self.annotation_path(name))
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    async def watch(self):
+        # A slide is picked up once its size and mtime and those of its
+        # annotation are the same on two consecutive polls, so files that are
+        # still being copied are skipped.
+        previous = {}
+        while True:
+            current = self.list_unprocessed()
+            for name, identity in sorted(current.items()):
+                if name in self.pending or self.waiting.get(name, (None, ))[0] == identity:
+                    continue
+                if self.args.once or previous.get(name) == identity:
+                    self.pending.add(name)
+                    await self.queue.put((name, identity))
+            if self.args.once:
+                return
+            previous = current
+            await asyncio.sleep(self.args.interval)
+
+    async def worker(self):
+        while True:
+            name, identity = await self.queue.get()
+            try:
+                await self.process(name, identity)
+            except Exception as exc:
+                self.log(0, '%s: failed: %r' % (name, exc))
+                path = os.path.join(self.folders['Unprocessed'], name)
+                try:
+                    if os.path.exists(path):
+                        self.finish(path, 'Quarantine', {'error': repr(exc)})
+                except Exception as exc:
+                    # Keep this worker running; the slide is retried if it
+                    # is still in Unprocessed.
+                    self.log(0, '%s: could not quarantine: %r' % (name, exc))
+            finally:
+                self.pending.discard(name)
+                self.queue.task_done()
+
+    async def stage(self, stage, func, *args):
+        async with self.limits[stage]:
+            loop = asyncio.get_running_loop()
+            with metrics.span(stage, file=args[0]):
+                return await loop.run_in_executor(self.pools[stage], func, *args)
+
+    async def process(self, name, identity):
+        path = os.path.join(self.folders['Unprocessed'], name)
+        waiting = self.waiting.pop(name, None)
+        if waiting and waiting[0][:2] == identity[:2]:
+            # Already scanned; only the annotation changed
+            report = waiting[1]
+        else:
+            self.log(1, '%s: scanning' % name)
+            readable, metadata_phi = await self.stage(
+                'metadata', scan_metadata, path, self.metadata_patterns, self.literals)
+            if not readable:
+                self.finish(path, 'Excluded', {'error': 'not a readable TIFF'})
+                return
+            ocr, ocr_phi, ocr_errors = await self.stage(
+                'ocr', scan_ocr, path, self.patterns, self.literals)
+            report = {
+                'metadata_phi': metadata_phi, 'ocr': ocr, 'ocr_phi': ocr_phi,
+                'ocr_errors': ocr_errors}
+            if metadata_phi or ocr_phi or ocr_errors:
+                self.finish(path, 'Quarantine', report)
+                return
+        annotation = self.annotation_path(name)
+        if not os.path.exists(annotation):
+            self.waiting[name] = (identity, report)
+            self.log(1, '%s: waiting for an annotation' % name)
+            return
+        self.log(1, '%s: redacting' % name)
+        partial = os.path.join(self.folders['Redacted'], '.%s.partial' % name)
+        try:
+            await self.stage('redact', redact_slide, path, annotation, partial)
+            dest = self.unique_path('Redacted', name)
+            os.replace(partial, dest)
+        finally:
+            if os.path.exists(partial):
+                os.unlink(partial)
+        self.write_report(dest, report)
+        self.finish(path, 'Original', report)
+        self.log(1, '%s: redacted' % name)
+
+    def unique_path(self, folder, name):
+        dest = os.path.join(self.folders[folder], name)
+        root, ext = os.path.splitext(dest)
+        idx = 1
+        while os.path.exists(dest):
+            dest = '%s.%d%s' % (root, idx, ext)
+            idx += 1
+        return dest
+
+    def finish(self, path, folder, report):
+        """
+        Move a slide from Unprocessed to another folder with its report and,
+        if it is in Unprocessed, its annotation.
+        """
+        dest = self.unique_path(folder, os.path.basename(path))
+        self.write_report(dest, report)
+        annotation = os.path.join(self.folders['Unprocessed'], os.path.basename(path) + '.json')
+        if os.path.exists(annotation):
+            os.replace(annotation, dest + '.json')
+        os.replace(path, dest)
+        metrics.count('slides_' + folder.lower())
+        self.log(1, '%s: moved to %s' % (os.path.basename(path), folder))
+
+    def write_report(self, dest, report):
+        partial = os.path.join(
+            os.path.dirname(dest), '.%s.report.partial' % os.path.basename(dest))
+        json.dump(report, open(partial, 'w'), indent=2)
+        os.replace(partial, dest + '.report.json')
+
+
+def main(args):
+    asyncio.run(WatchFolder(args).run())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Watch a directory laid out like the Redaction collection '
+        '(Unprocessed, Redacted, Processed, Original, Excluded, Quarantine) and '
+        'scan, redact, and sort each slide added to Unprocessed.')
+    parser.add_argument(
+        'root', help='Directory containing the workflow folders.  Missing '
+        'folders are created.')
+    parser.add_argument(
+        '--annotations',
+        help='A directory with annotation files named <slide file name>.json.  '
+        'Defaults to the Unprocessed folder.')
+    parser.add_argument(
+        '--patterns',
+        help='A file of tesseract-style user patterns, one per line, to scan '
+        'for PHI instead of the default patterns.')
+    parser.add_argument(
+        '--metadata-patterns',
+        help='A file of tesseract-style user patterns, one per line, to scan '
+        'metadata with instead of those used for OCR.  The default date '
+        'patterns match the Date field of every Aperio SVS file, so use this '
+        'to keep those from all being quarantined.')
+    parser.add_argument(
+        '--literals',
+        help='A file of literal strings, one per line, to scan for PHI.  End a '
+        'line with * to match it as a prefix.')
+    parser.add_argument(
+        '--interval', type=float, default=5,
+        help='Seconds between checks of the Unprocessed folder.')
+    parser.add_argument(
+        '--queue', type=int, default=8,
+        help='Maximum number of slides waiting to be processed.')
+    parser.add_argument(
+        '--metadata-workers', type=int, default=2,
+        help='Processes scanning metadata.')
+    parser.add_argument(
+        '--ocr-workers', type=int, default=os.cpu_count() or 1,
+        help='Processes running OCR.')
+    parser.add_argument(
+        '--redact-workers', type=int, default=1,
+        help='Processes redacting slides.')
+    parser.add_argument(
+        '--once', action='store_true',
+        help='Process the slides currently in Unprocessed and exit.')
+    parser.add_argument(
+        '--verbose', '-v', action='count', default=0, help='Increase output.')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure_from_args(args)
+    main(args)